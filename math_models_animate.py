@@ -1,11 +1,21 @@
+import os
+import inspect
+import subprocess
+import matplotlib
 import matplotlib.pyplot as plt
 from matplotlib.animation import FuncAnimation
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 import math_models_util as util
 
+class AnimateException(Exception):
+    pass
+
 class Animate:
-    def __init__(self, x, ys, labels=None, colors=None, preFtn=None):
-        self.x = x
-        self.ys = ys
+    def __init__(self, x, ys, labels=None, colors=None, preFtn=None, maxPoints=None):
+        # Arrays, so per-frame prefixes and segments are views rather than copies.
+        # Series longer than maxPoints are downsampled keeping each bucket's extremes.
+        self.x, self.ys = util.downsample(x, ys, maxPoints)
         self.labels = labels
         self.colors = colors
         self.preFtn = preFtn
@@ -36,6 +46,73 @@ class Animate:
                       blit=True,
                       repeat=False)
 
+    def save(self,
+             filename,
+             fps=30,
+             dpi=100,
+             step=1,
+             maxFrames=None,
+             title=None,
+             legend=None,
+             xlabel=None,
+             ylabel=None):
+        # Headless rendering on an Agg canvas, no pyplot figure or display needed.
+        # The background is drawn once; each frame then only draws the segment
+        # added since the previous frame on top of the previous frame's pixels.
+        gridSize = util.XYsMinMaxRange(self.x, self.ys)
+
+        fig = Figure(dpi=dpi)
+        canvas = FigureCanvasAgg(fig)
+        ax = fig.add_subplot(xlim=gridSize.xRange(), ylim=gridSize.yRange())
+        self.callPreFtn_(ax)
+
+        self.lines = [ax.plot([], [], c, label=l)[0] for c, l in zip(self.colors, self.labels)]
+        if xlabel is not None:
+            ax.set_xlabel(xlabel)
+        if ylabel is not None:
+            ax.set_ylabel(ylabel)
+        if title is not None:
+            ax.set_title(title)
+        if legend is not None:
+            ax.legend(loc=legend)
+        ax.grid(True)
+        canvas.draw()
+
+        frames = self.frames(step, maxFrames)
+        with frameWriter_(filename, canvas, fps) as writer:
+            last = 0
+            for i in frames:
+                self.drawSegment_(ax, last, i)
+                if ax.get_legend() is not None:
+                    ax.draw_artist(ax.get_legend())
+                writer.write(canvas.buffer_rgba())
+                last = i
+        self.lines = None
+        return len(frames)
+
+    def frames(self, step=1, maxFrames=None):
+        # Frame i shows the first i points; step and maxFrames skip frames but
+        # the last frame always shows the full series
+        n = len(self.x)
+        if maxFrames is not None:
+            step = max(step, -(-n // maxFrames))
+        frames = list(range(step, n, step))
+        return frames + [n] if n > 0 else frames
+
+    def callPreFtn_(self, ax):
+        if not callable(self.preFtn):
+            return
+        if inspect.signature(self.preFtn).parameters:
+            self.preFtn(ax)
+        else:
+            self.preFtn()
+
+    def drawSegment_(self, ax, start, stop):
+        first = max(start - 1, 0)
+        for line, y in zip(self.lines, self.ys):
+            line.set_data(self.x[first:stop], y[first:stop])
+            ax.draw_artist(line)
+
     def initLines_(self):
         for line in self.lines:
             line.set_data([], [])
@@ -45,3 +122,79 @@ class Animate:
         for line, y in zip(self.lines, self.ys):
             line.set_data(self.x[:i], y[:i])
         return self.lines
+
+class GifWriter_:
+    # Streams each frame to the file as it is rendered, so memory holds one
+    # frame however long the animation. Frames after the first only store the
+    # box that changed, quantized to its own local palette.
+    def __init__(self, filename, canvas, fps):
+        self.filename = filename
+        self.duration = 1000.0 / fps
+        self.size = canvas.get_width_height()
+        self.file = open(filename, 'wb')
+        self.previous = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        if excType is None and self.previous is not None:
+            self.file.write(b';')
+        self.file.close()
+        if excType is not None or self.previous is None:
+            os.remove(self.filename)
+
+    def write(self, rgba):
+        from PIL import GifImagePlugin, Image, ImageChops
+        image = Image.frombuffer('RGBA', self.size, bytes(rgba), 'raw', 'RGBA', 0, 1).convert('RGB')
+        if self.previous is None:
+            box = (0, 0) + self.size
+        else:
+            box = ImageChops.difference(image, self.previous).getbbox() or (0, 0, 1, 1)
+        frame = image.crop(box).quantize(method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE)
+        if self.previous is None:
+            header, _ = GifImagePlugin.getheader(frame, info={'loop': 0})
+            self.file.write(b''.join(header))
+        self.file.write(b''.join(GifImagePlugin.getdata(frame, box[:2], duration=self.duration, include_color_table=True)))
+        self.previous = image
+
+class FFMpegWriter_:
+    def __init__(self, filename, canvas, fps):
+        width, height = canvas.get_width_height()
+        self.filename = filename
+        self.proc = subprocess.Popen([matplotlib.rcParams['animation.ffmpeg_path'],
+                                      '-y', '-loglevel', 'error',
+                                      '-f', 'rawvideo', '-pix_fmt', 'rgba',
+                                      '-s', '{}x{}'.format(width, height),
+                                      '-r', str(fps),
+                                      '-i', 'pipe:',
+                                      '-pix_fmt', 'yuv420p',
+                                      filename],
+                                     stdin=subprocess.PIPE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        if self.proc.wait() != 0 and excType is None:
+            self.fail_()
+
+    def write(self, rgba):
+        try:
+            self.proc.stdin.write(rgba)
+        except BrokenPipeError:
+            self.proc.wait()
+            self.fail_()
+
+    def fail_(self):
+        raise(AnimateException(
+            "Animate.save: ffmpeg failed ({}) writing {}".format(self.proc.returncode, self.filename)))
+
+def frameWriter_(filename, canvas, fps):
+    if filename.lower().endswith('.gif'):
+        return GifWriter_(filename, canvas, fps)
+    return FFMpegWriter_(filename, canvas, fps)
@@ -0,0 +1,144 @@
+import os
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+import sys
+import json
+import time
+import platform
+import tempfile
+import numpy as np
+import matplotlib.pyplot as plt
+import math_models_animate as anim
+import math_models_epidemic as epidemic
+import math_models_population as population
+import math_models_util as util
+import test_population
+
+def timeIt(ftn, repeat=5, number=None, minTime=0.05):
+    # Best of repeat runs, in seconds per call. Unless given, number is sized
+    # so each run takes at least minTime.
+    if number is None:
+        start = time.perf_counter()
+        ftn()
+        number = max(1, int(minTime / max(time.perf_counter() - start, 1e-9)))
+
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            ftn()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+def epidemicSolve_(model, timeSteps):
+    return lambda: epidemic.solve(model, 20, timeSteps)
+
+def populationSolve_(capacity):
+    model = population.LogisticModel(0.02, 4500000, capacity)
+    return lambda: population.solve(model, maxTime=250)
+
+def piecewisePoints_(numPoints):
+    pw = util.PiecewiseFtn(np.arange(1, 50), np.linspace(0, 1, 50))
+    x = np.linspace(0, 60, numPoints)
+    return lambda: pw(x)
+
+def functionPoints_(ftn, numPoints):
+    x = np.linspace(0, 250, numPoints)
+    return lambda: util.FunctionPoints(ftn, x)
+
+def downsample_(numPoints, method):
+    t, sir = epidemic.solve(epidemic.SIRModel(), 20, numPoints)
+    ys = [sir[:, i] for i in range(3)]
+    return lambda: util.downsample(t, ys, 10000, method)
+
+def animationFrames_(numPoints, numFrames=20):
+    t, sir = epidemic.solve(epidemic.SIRModel(), 20, numPoints)
+    animation = anim.Animate(t, [sir[:, i] for i in range(3)], labels=['S', 'I', 'R'], colors=['b', 'r', 'g'])
+    fig = plt.figure()
+    ax = plt.axes(xlim=(0, 20), ylim=(0, 1))
+    animation.lines = [ax.plot([], [], c, label=l)[0] for c, l in zip(animation.colors, animation.labels)]
+    frames = np.linspace(1, numPoints, numFrames, dtype=int)
+
+    def draw():
+        for i in frames:
+            animation.updateLines_(i)
+            fig.canvas.draw()
+    return draw
+
+def animationSave_(numPoints, numFrames=20):
+    t, sir = epidemic.solve(epidemic.SIRModel(), 20, numPoints)
+    animation = anim.Animate(t, [sir[:, i] for i in range(3)], labels=['S', 'I', 'R'], colors=['b', 'r', 'g'])
+    filename = os.path.join(tempfile.gettempdir(), 'math_models_bench.gif')
+    return lambda: animation.save(filename, dpi=50, maxFrames=numFrames)
+
+def benchmarks():
+    return {
+        'epidemic.solve.sir.100': epidemicSolve_(epidemic.SIRModel(), 100),
+        'epidemic.solve.sir.10000': epidemicSolve_(epidemic.SIRModel(), 10000),
+        'epidemic.solve.seir.100': epidemicSolve_(epidemic.SEIRModel(reducedEIRate=0.25), 100),
+        'epidemic.solve.seir.10000': epidemicSolve_(epidemic.SEIRModel(reducedEIRate=0.25), 10000),
+        'epidemic.solve.seir.100000': epidemicSolve_(epidemic.SEIRModel(reducedEIRate=0.25), 100000),
+        'population.solve.piecewise': populationSolve_(test_population.piecewiseCapacity()),
+        'population.solve.continuous': populationSolve_(test_population.continuousCapacity()),
+        'util.PiecewiseFtn.1000000': piecewisePoints_(1000000),
+        'util.FunctionPoints.piecewise.10000': functionPoints_(test_population.piecewiseCapacity(), 10000),
+        'util.FunctionPoints.continuous.10000': functionPoints_(test_population.continuousCapacity(), 10000),
+        'util.downsample.minmax.1000000': downsample_(1000000, 'minmax'),
+        'util.downsample.lttb.1000000': downsample_(1000000, 'lttb'),
+        'anim.Animate.frames.1000': animationFrames_(1000),
+        'anim.Animate.frames.100000': animationFrames_(100000),
+        'anim.Animate.save.100000': animationSave_(100000),
+    }
+
+def runBenchmarks(names=None, repeat=5):
+    results = {}
+    for name, ftn in benchmarks().items():
+        if names is None or any(name.startswith(n) for n in names):
+            results[name] = timeIt(ftn, repeat=repeat)
+    plt.close('all')
+    return results
+
+def compareResults(results, baseline, threshold=0.25):
+    # Returns (name, baseline, current, ratio) for benchmarks slower than
+    # baseline by more than threshold
+    regressions = []
+    for name, current in sorted(results.items()):
+        if name in baseline:
+            ratio = current / baseline[name]
+            if ratio > 1 + threshold:
+                regressions.append((name, baseline[name], current, ratio))
+    return regressions
+
+def saveResults(results, path):
+    with open(path, 'w') as f:
+        json.dump({'python': platform.python_version(),
+                   'numpy': np.__version__,
+                   'machine': platform.machine(),
+                   'results': results},
+                  f,
+                  indent=2,
+                  sort_keys=True)
+
+def loadResults(path):
+    with open(path) as f:
+        return json.load(f)['results']
+
+def run(output=None, baseline=None, threshold=0.25):
+    results = runBenchmarks()
+    for name, seconds in sorted(results.items()):
+        print('{:45} {:12.6f}'.format(name, seconds))
+    if output is not None:
+        saveResults(results, output)
+
+    if baseline is None:
+        return True
+    regressions = compareResults(results, loadResults(baseline), threshold)
+    for name, base, current, ratio in regressions:
+        print('REGRESSION {}: {:.6f} -> {:.6f} ({:.2f}x)'.format(name, base, current, ratio))
+    return not regressions
+
+if __name__ == '__main__':
+    ok = run(sys.argv[1] if len(sys.argv) > 1 else None,
+             sys.argv[2] if len(sys.argv) > 2 else None,
+             float(sys.argv[3]) if len(sys.argv) > 3 else 0.25)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,113 @@
+import os
+import json
+import hashlib
+import numpy as np
+import math_models_epidemic as epidemic
+import math_models_store as store
+
+class SolveCacheException(Exception):
+    pass
+
+class SolveCache:
+    # On-disk cache of epidemic.solve results, one <key>.npz per entry. The key
+    # hashes the model type, parameters(), initial conditions and solve
+    # arguments; least recently used entries are evicted above maxBytes.
+    def __init__(self, directory, maxBytes=1 << 30, solveFtn=epidemic.solve):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.solveFtn = solveFtn
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def __str__(self):
+        return 'SolveCache({}, {})'.format(self.directory, self.maxBytes)
+
+    def __repr__(self):
+        return str(self)
+
+    def key(self, model, maxTime, timeSteps, **kwargs):
+        if not isinstance(model, (epidemic.CompartmentModelBase, epidemic.SweepModel)):
+            raise(SolveCacheException(
+                "SolveCache: model ({}) is not an epidemic model".format(type(model).__name__)))
+
+        try:
+            parameters = store.jsonable_(model.parameters())
+            initialConditions = store.jsonable_(model.initialConditions)
+        except TypeError as e:
+            raise(SolveCacheException(
+                "SolveCache: model ({!r}) cannot be keyed - use util function classes for schedules: {}".format(
+                    model, e)))
+
+        try:
+            payload = json.dumps({'solve': '{}.{}'.format(self.solveFtn.__module__, self.solveFtn.__name__),
+                                  'type': '{}.{}'.format(type(model).__module__, type(model).__name__),
+                                  'parameters': parameters,
+                                  'initialConditions': initialConditions,
+                                  'maxTime': maxTime,
+                                  'timeSteps': timeSteps,
+                                  'kwargs': store.jsonable_(kwargs)},
+                                 sort_keys=True)
+        except TypeError as e:
+            raise(SolveCacheException(
+                "SolveCache: solve arguments ({}) cannot be keyed: {}".format(', '.join(sorted(kwargs)), e)))
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def solve(self, model, maxTime=10, timeSteps=100, **kwargs):
+        path = self.path_(self.key(model, maxTime, timeSteps, **kwargs))
+        if os.path.exists(path):
+            try:
+                with np.load(path) as data:
+                    t, ys = data['t'], data['ys']
+            except (OSError, ValueError, KeyError):
+                remove_(path)
+            else:
+                self.hits += 1
+                os.utime(path)
+                return t, ys
+
+        self.misses += 1
+        t, ys = self.solveFtn(model, maxTime, timeSteps, **kwargs)
+        # Written aside and renamed into place, so concurrent readers never
+        # see a partial entry
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.savez(f, t=t, ys=ys)
+        os.replace(tmp, path)
+        self.evict_()
+        return t, ys
+
+    def entries(self):
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.npz')]
+        return sorted(paths, key=os.path.getmtime)
+
+    def size(self):
+        return sum(os.path.getsize(path) for path in self.entries())
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries()), 'bytes': self.size()}
+
+    def clear(self):
+        for path in self.entries():
+            os.remove(path)
+        self.hits = 0
+        self.misses = 0
+
+    def path_(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def evict_(self):
+        entries = self.entries()
+        total = sum(os.path.getsize(path) for path in entries)
+        for path in entries[:-1]:
+            if total <= self.maxBytes:
+                break
+            total -= os.path.getsize(path)
+            remove_(path)
+
+def remove_(path):
+    # Another process may have evicted the entry already
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,117 @@
+import numpy as np
+
+class EnsembleStatsException(Exception):
+    pass
+
+class EnsembleStats:
+    # Streaming reducer over trajectories shaped (timeSteps, compartments), fed
+    # one at a time or in batches (runs, timeSteps, compartments). Mean and
+    # variance are merged batch by batch (Chan/Welford); quantiles come from a
+    # uniform reservoir of at most reservoirSize whole trajectories, so they are
+    # exact until more than reservoirSize runs have been seen. Memory is
+    # bounded by the reservoir whatever the number of runs.
+    def __init__(self, reservoirSize=1000, seed=None):
+        self.reservoirSize = reservoirSize
+        self.rng = np.random.default_rng(seed)
+        self.count = 0
+        self.shape = None
+        self.mean_ = None
+        self.m2_ = None
+        self.min_ = None
+        self.max_ = None
+        self.reservoir_ = None
+
+    def __str__(self):
+        return 'EnsembleStats({}, {})'.format(self.count, self.shape)
+
+    def __repr__(self):
+        return str(self)
+
+    def __len__(self):
+        return self.count
+
+    def update(self, ys):
+        ys = np.asarray(ys, dtype=float)
+        if self.shape is None:
+            self.start_(ys.shape[-2:] if ys.ndim >= 2 else ys.shape)
+        if ys.shape == self.shape:
+            ys = ys[np.newaxis]
+        if ys.shape[1:] != self.shape:
+            raise(EnsembleStatsException(
+                "EnsembleStats: trajectory shape ({}) does not match {}".format(ys.shape[1:], self.shape)))
+        if not len(ys):
+            return self
+
+        n = len(ys)
+        mean = ys.mean(axis=0)
+        m2 = ((ys - mean) ** 2).sum(axis=0)
+        total = self.count + n
+        delta = mean - self.mean_
+        self.mean_ += delta * (n / total)
+        self.m2_ += m2 + delta ** 2 * (self.count * n / total)
+        np.minimum(self.min_, ys.min(axis=0), out=self.min_)
+        np.maximum(self.max_, ys.max(axis=0), out=self.max_)
+        self.sample_(ys)
+        self.count = total
+        return self
+
+    def extend(self, batches):
+        for ys in batches:
+            self.update(ys)
+        return self
+
+    def mean(self):
+        self.check_()
+        return self.mean_.copy()
+
+    def variance(self, ddof=1):
+        self.check_()
+        return self.m2_ / max(self.count - ddof, 1)
+
+    def std(self, ddof=1):
+        return np.sqrt(self.variance(ddof))
+
+    def min(self):
+        self.check_()
+        return self.min_.copy()
+
+    def max(self):
+        self.check_()
+        return self.max_.copy()
+
+    def quantiles(self, qs=(0.05, 0.5, 0.95)):
+        # Shaped (len(qs), timeSteps, compartments)
+        self.check_()
+        return np.quantile(self.reservoir_[:min(self.count, self.reservoirSize)], qs, axis=0)
+
+    def band(self, lower=0.05, upper=0.95):
+        # (lower, upper) pair for the bands argument of epidemic.plot/population.plot
+        lowerBand, upperBand = self.quantiles((lower, upper))
+        return lowerBand, upperBand
+
+    def start_(self, shape):
+        self.shape = tuple(shape)
+        self.mean_ = np.zeros(self.shape)
+        self.m2_ = np.zeros(self.shape)
+        self.min_ = np.full(self.shape, np.inf)
+        self.max_ = np.full(self.shape, -np.inf)
+        self.reservoir_ = np.empty((self.reservoirSize,) + self.shape)
+
+    def sample_(self, ys):
+        # Algorithm R: run i replaces a uniform slot j < i + 1 when j falls in
+        # the reservoir; only the last replacement of each slot in a batch is kept
+        fill = max(0, min(len(ys), self.reservoirSize - self.count))
+        self.reservoir_[self.count:self.count + fill] = ys[:fill]
+        if fill == len(ys):
+            return
+
+        seen = self.count + np.arange(fill, len(ys))
+        slots = self.rng.integers(0, seen + 1)
+        keep = slots < self.reservoirSize
+        slots, runs = slots[keep], np.arange(fill, len(ys))[keep]
+        last, index = np.unique(slots[::-1], return_index=True)
+        self.reservoir_[last] = ys[runs[::-1][index]]
+
+    def check_(self):
+        if not self.count:
+            raise(EnsembleStatsException("EnsembleStats: no trajectories"))
@@ -1,9 +1,19 @@
 import numpy as np
-from scipy.integrate import odeint
-import matplotlib.pyplot as plt
-import math_models_animate as anim
+from scipy import sparse
+import math_models_integrate as integ
+import math_models_util as util
+
+# matplotlib and math_models_animate are imported inside plot/animate so
+# solve-only workloads do not load them
+
+class EpidemicException(Exception):
+    pass
 
 class CompartmentModelBase:
+    # Slotted so large scenario lists carry no per-instance __dict__; subclasses
+    # pass class-level label and color tuples that every instance shares
+    __slots__ = ('numCompartments', 'initialConditions', 'labels', 'colors')
+
     def __init__(self, initialConditions, labels, colors):
         self.numCompartments = len(initialConditions)
         self.initialConditions = initialConditions
@@ -19,9 +29,25 @@ class CompartmentModelBase:
     def labelColor(self, label):
         return self.colors[self.labels.index(label)]
 
+    def breakpoints(self):
+        # Times where a scheduled parameter jumps; solvers restart there.
+        # Subclasses without parameters() have none.
+        if not hasattr(self, 'parameters'):
+            return util.breakpoints()
+        return util.breakpoints(*self.parameters().values())
+
+def valueAt_(parameter, t):
+    # Parameters are constants or schedules of t, e.g. PiecewiseFtn lockdowns
+    return parameter(t) if callable(parameter) else parameter
+
 class SIRModel(CompartmentModelBase):
+    __slots__ = ('transmitRate', 'removeRate')
+    jacobianBands = (1, 1)
+    LABELS = ('Susceptible', 'Infected', 'Removed')
+    COLORS = ('b', 'r', 'g')
+
     def __init__(self, transmitRate=3.5, removeRate=0.5, sir0=(0.99, 0.01, 0.0)):
-        super().__init__(sir0, ['Susceptible', 'Infected', 'Removed'], ['b', 'r', 'g'])
+        super().__init__(sir0, self.LABELS, self.COLORS)
         self.transmitRate = transmitRate
         self.removeRate = removeRate
 
@@ -31,28 +57,51 @@ class SIRModel(CompartmentModelBase):
     def __repr__(self):
         return 'SIR({}, {})'.format(self.transmitRate, self.removeRate)
 
+    def parameters(self):
+        return {'transmitRate': self.transmitRate, 'removeRate': self.removeRate}
+
     def __call__(self, sir, t):
         # S'(t) = - transmitRate * S(t) * I(t)
         # I'(t) = transmitRate * S(t) * I(t) - removeRate * I(t)
         # R'(t) = removeRate * I(t)
 
-        transmitted = self.transmitRate * sir[0] * sir[1]
-        removed = self.removeRate * sir[1]
+        transmitted = valueAt_(self.transmitRate, t) * sir[0] * sir[1]
+        removed = valueAt_(self.removeRate, t) * sir[1]
         dS = - transmitted
         dI = transmitted - removed
         dR = removed
         return dS, dI, dR
 
+    def flowModel(self):
+        return FlowModel(self.initialConditions,
+                         self.labels,
+                         self.colors,
+                         [('Susceptible', 'Infected', self.transmitRate, {'Infected': 1.0}),
+                          ('Infected', 'Removed', self.removeRate)])
+
+    def jacobian(self, sir, t):
+        transmitRate = valueAt_(self.transmitRate, t)
+        removeRate = valueAt_(self.removeRate, t)
+        transmitS = transmitRate * sir[0]
+        transmitI = transmitRate * sir[1]
+        zero = np.zeros_like(transmitS)
+        return np.array([[-transmitI, -transmitS, zero],
+                         [transmitI, transmitS - removeRate, zero],
+                         [zero, zero + removeRate, zero]])
+
 class SEIRModel(CompartmentModelBase):
+    __slots__ = ('transmitRate', 'reducedEIRate', 'infectRate', 'removeRate')
+    jacobianBands = (1, 2)
+    LABELS = ('Susceptible', 'Exposed', 'Infected', 'Removed')
+    COLORS = ('b', 'c', 'r', 'g')
+
     def __init__(self,
                  transmitRate=3.5,
                  reducedEIRate=0.0,
                  infectRate=1.0,
                  removeRate=0.5,
                  seir0=(0.99, 0.01, 0.0, 0.0)):
-        super().__init__(seir0,
-                         ['Susceptible', 'Exposed', 'Infected', 'Removed'],
-                         ['b', 'c', 'r', 'g'])
+        super().__init__(seir0, self.LABELS, self.COLORS)
         self.transmitRate = transmitRate
         self.reducedEIRate = reducedEIRate
         self.infectRate = infectRate
@@ -66,33 +115,711 @@ class SEIRModel(CompartmentModelBase):
             self.removeRate)
 
     def __repr__(self):
-        return 'SIR({}, {}, {}, {})'.format(
+        return 'SEIR({}, {}, {}, {})'.format(
             self.transmitRate,
             self.reducedEIRate,
             self.infectRate,
             self.removeRate)
 
+    def parameters(self):
+        return {'transmitRate': self.transmitRate,
+                'reducedEIRate': self.reducedEIRate,
+                'infectRate': self.infectRate,
+                'removeRate': self.removeRate}
+
     def __call__(self, seir, t):
         # S'(t) = - transmitRate * S(t) * (I(t) + reducedEIRate * E(t))
         # E'(t) = transmitRate * S(t) * (I(t) + reducedEIRate * E(t)) - infectRate * E(t)
         # I'(t) = infectRate * E(t) - removeRate * I(t)
         # R'(t) = removeRate * I(t)
 
-        transmitted = self.transmitRate * seir[0] * (seir[2] + self.reducedEIRate * seir[1])
-        infected = self.infectRate * seir[1]
-        removed = self.removeRate * seir[2]
+        transmitted = valueAt_(self.transmitRate, t) * seir[0] * (seir[2] + valueAt_(self.reducedEIRate, t) * seir[1])
+        infected = valueAt_(self.infectRate, t) * seir[1]
+        removed = valueAt_(self.removeRate, t) * seir[2]
         dS = - transmitted
         dE = transmitted - infected
         dI = infected - removed
         dR = removed
         return dS, dE, dI, dR
 
-def solve(model=SIRModel(), maxTime=10, timeSteps=100):
+    def flowModel(self):
+        return FlowModel(self.initialConditions,
+                         self.labels,
+                         self.colors,
+                         [('Susceptible', 'Exposed', self.transmitRate,
+                           {'Infected': 1.0, 'Exposed': self.reducedEIRate}),
+                          ('Exposed', 'Infected', self.infectRate),
+                          ('Infected', 'Removed', self.removeRate)])
+
+    def jacobian(self, seir, t):
+        transmitRate = valueAt_(self.transmitRate, t)
+        reducedEIRate = valueAt_(self.reducedEIRate, t)
+        infectRate = valueAt_(self.infectRate, t)
+        removeRate = valueAt_(self.removeRate, t)
+        force = transmitRate * (seir[2] + reducedEIRate * seir[1])
+        transmitS = transmitRate * seir[0]
+        zero = np.zeros_like(transmitS)
+        return np.array([[-force, -transmitS * reducedEIRate, -transmitS, zero],
+                         [force, transmitS * reducedEIRate - infectRate, transmitS, zero],
+                         [zero, zero + infectRate, zero - removeRate, zero],
+                         [zero, zero, zero + removeRate, zero]])
+
+class AgeSEIRModel(CompartmentModelBase):
+    # SEIR per group mixed through a K x K contact matrix, contactMatrix[i, j]
+    # being group i's contact rate with group j. State is compartment-major,
+    # (S_1..S_K, E_1..E_K, I_1..I_K, R_1..R_K), as fractions of the whole
+    # population; rates are scalars or per group arrays.
+    __slots__ = ('contactMatrix', 'groupFractions', 'groups', 'numGroups',
+                 'transmitRate', 'reducedEIRate', 'infectRate', 'removeRate', 'mixing_')
+    LABELS = SEIRModel.LABELS
+    COLORS = SEIRModel.COLORS
+
+    def __init__(self,
+                 contactMatrix,
+                 transmitRate=3.5,
+                 reducedEIRate=0.0,
+                 infectRate=1.0,
+                 removeRate=0.5,
+                 groupFractions=None,
+                 groups=None,
+                 seir0=(0.99, 0.01, 0.0, 0.0)):
+        self.contactMatrix = np.asarray(contactMatrix, dtype=float)
+        if self.contactMatrix.ndim != 2 or self.contactMatrix.shape[0] != self.contactMatrix.shape[1]:
+            raise(EpidemicException(
+                "AgeSEIRModel: contactMatrix must be square - got shape {}".format(self.contactMatrix.shape)))
+        self.numGroups = len(self.contactMatrix)
+        K = self.numGroups
+        self.groupFractions = (np.full(K, 1.0 / K) if groupFractions is None
+                               else np.asarray(groupFractions, dtype=float))
+        self.groups = tuple(str(g) for g in (range(K) if groups is None else groups))
+        for name, values in (('groupFractions', self.groupFractions), ('groups', self.groups)):
+            if np.shape(values) != (K,):
+                raise(EpidemicException(
+                    "AgeSEIRModel: invalid {} - expected {} values to match contactMatrix, got {}".format(
+                        name, K, len(np.atleast_1d(values)))))
+        self.transmitRate, self.reducedEIRate, self.infectRate, self.removeRate = (
+            np.broadcast_to(np.asarray(rate, dtype=float), (K,)) for rate in (transmitRate, reducedEIRate, infectRate, removeRate))
+
+        # Prevalence within group j is I_j / N_j, so scaling columns once leaves
+        # a single matrix-vector product per RHS call
+        self.mixing_ = self.contactMatrix / self.groupFractions
+
+        # seir0 is per group, as fractions of each group: shape (4,) or (4, K)
+        state0 = np.broadcast_to(np.asarray(seir0, dtype=float).reshape(4, -1), (4, K)) * self.groupFractions
+        super().__init__(tuple(state0.ravel().tolist()),
+                         tuple('{} {}'.format(label, group) for label in self.LABELS for group in self.groups),
+                         tuple(color for base in self.COLORS for color in shades_(base, K)))
+
+    def __str__(self):
+        return 'AgeSEIR: Groups={} Transmit={} ReduceEI={} Infect={} Remove={}'.format(
+            self.numGroups,
+            self.transmitRate.tolist(),
+            self.reducedEIRate.tolist(),
+            self.infectRate.tolist(),
+            self.removeRate.tolist())
+
+    def __repr__(self):
+        return 'AgeSEIR({}, {}, {}, {}, {})'.format(
+            self.contactMatrix.tolist(),
+            self.transmitRate.tolist(),
+            self.reducedEIRate.tolist(),
+            self.infectRate.tolist(),
+            self.removeRate.tolist())
+
+    def parameters(self):
+        return {'contactMatrix': self.contactMatrix.tolist(),
+                'groupFractions': self.groupFractions.tolist(),
+                'transmitRate': self.transmitRate.tolist(),
+                'reducedEIRate': self.reducedEIRate.tolist(),
+                'infectRate': self.infectRate.tolist(),
+                'removeRate': self.removeRate.tolist()}
+
+    @property
+    def jacobianBands(self):
+        # E, I and R depend on the previous block; S on the E and I blocks
+        return (self.numGroups, 3 * self.numGroups - 1)
+
+    def force(self, seir):
+        # transmitRate_i * sum_j contact[i, j] * (I_j + reducedEIRate_j * E_j) / N_j
+        _, e, i, _ = np.reshape(seir, (4, self.numGroups, -1))
+        rates = self.transmitRate[:, np.newaxis]
+        return rates * (self.mixing_ @ (i + self.reducedEIRate[:, np.newaxis] * e))
+
+    def __call__(self, seir, t):
+        s, e, i, _ = np.reshape(seir, (4, self.numGroups, -1))
+        transmitted = s * self.force(seir)
+        infected = self.infectRate[:, np.newaxis] * e
+        removed = self.removeRate[:, np.newaxis] * i
+        return np.stack([-transmitted,
+                         transmitted - infected,
+                         infected - removed,
+                         removed]).reshape(np.shape(seir))
+
+    def jacobian(self, seir, t):
+        K = self.numGroups
+        s, _, _, _ = np.reshape(seir, (4, K))
+        force = np.diag(self.force(seir).ravel())
+        dForceI = (self.transmitRate * s)[:, np.newaxis] * self.mixing_
+        dForceE = dForceI * self.reducedEIRate
+        infect = np.diag(self.infectRate)
+        remove = np.diag(self.removeRate)
+        zero = np.zeros((K, K))
+        return np.block([[-force, -dForceE, -dForceI, zero],
+                         [force, dForceE - infect, dForceI, zero],
+                         [zero, infect, -remove, zero],
+                         [zero, zero, remove, zero]])
+
+    def flowModel(self):
+        flows = []
+        for g, group in enumerate(self.groups):
+            force = {}
+            for h, other in enumerate(self.groups):
+                if self.mixing_[g, h]:
+                    force['Infected {}'.format(other)] = self.mixing_[g, h]
+                    force['Exposed {}'.format(other)] = self.mixing_[g, h] * self.reducedEIRate[h]
+            flows.extend([('Susceptible {}'.format(group), 'Exposed {}'.format(group), self.transmitRate[g], force),
+                          ('Exposed {}'.format(group), 'Infected {}'.format(group), self.infectRate[g]),
+                          ('Infected {}'.format(group), 'Removed {}'.format(group), self.removeRate[g])])
+        return FlowModel(self.initialConditions, self.labels, self.colors, flows)
+
+    def compartment(self, label, group):
+        return self.labels.index('{} {}'.format(label, group))
+
+    def totals(self, ys):
+        # Sums groups, (timeSteps, 4 * numGroups) -> (timeSteps, 4) in SEIRModel label order
+        ys = np.asarray(ys)
+        return ys.reshape(ys.shape[:-1] + (4, self.numGroups)).sum(axis=-1)
+
+# Matplotlib's single letter colors, so group shades need no matplotlib import
+baseColors_ = {'b': (0.0, 0.0, 1.0), 'c': (0.0, 0.75, 0.75), 'r': (1.0, 0.0, 0.0), 'g': (0.0, 0.5, 0.0),
+               'm': (0.75, 0.0, 0.75), 'y': (0.75, 0.75, 0.0), 'k': (0.0, 0.0, 0.0)}
+
+def shades_(color, numShades):
+    # Hex colors from color itself to two thirds of the way to white
+    rgb = np.array(baseColors_[color])
+    mix = np.linspace(0, 2 / 3, numShades) if numShades > 1 else np.zeros(1)
+    return ['#{:02x}{:02x}{:02x}'.format(*np.round(255 * (rgb + m * (1 - rgb))).astype(int)) for m in mix]
+
+class FlowModel(CompartmentModelBase):
+    def __init__(self, initialConditions, labels, colors, flows=(), sparseMatrices=None):
+        super().__init__(initialConditions, labels, colors)
+        self.flows = []
+        self.sparseMatrices = sparseMatrices
+        self.compiled_ = False
+        for flow in flows:
+            self.addFlow(*flow)
+
+    def __str__(self):
+        return 'Flow: {}'.format(' '.join('{}->{}'.format(source, target) for source, target, _, _ in self.flows))
+
+    def __repr__(self):
+        return 'Flow({})'.format(', '.join('({}, {}, {})'.format(source, target, rate)
+                                           for source, target, rate, _ in self.flows))
+
+    def parameters(self):
+        return {'flows': [[source, target, rate, force] for source, target, rate, force in self.flows]}
+
+    def addFlow(self, source, target, rate, force=None):
+        # flux = rate * y[source] * sum(weight * y[label] for label, weight in force)
+        # with an unforced flow using 1 for the sum. A target of None is an outflow.
+        # Rates are constants: the stochastic simulations and metapopulation
+        # coupling built on flows do not take schedules.
+        if callable(rate):
+            raise(EpidemicException(
+                "FlowModel: rate ({!r}) of flow {} -> {} is a schedule - flow models need constant rates".format(
+                    rate, source, target)))
+        self.flows.append((source, target, rate, dict(force) if force else None))
+        self.compiled_ = False
+        return self
+
+    def compile_(self):
+        numFlows = len(self.flows)
+        index = self.labels.index
+        self.sources_ = np.array([index(source) for source, _, _, _ in self.flows], dtype=int)
+        self.rates_ = np.array([rate for _, _, rate, _ in self.flows], dtype=float).reshape(numFlows, 1)
+        self.base_ = np.array([force is None for _, _, _, force in self.flows], dtype=float).reshape(numFlows, 1)
+
+        stoichiometry = np.zeros((self.numCompartments, numFlows))
+        forces = np.zeros((numFlows, self.numCompartments))
+        for k, (source, target, _, force) in enumerate(self.flows):
+            stoichiometry[index(source), k] -= 1
+            if target is not None:
+                stoichiometry[index(target), k] += 1
+            for label, weight in (force or {}).items():
+                forces[k, index(label)] += weight
+
+        # Jacobian sparsity: flux k depends on its source and its force compartments
+        dependence = (np.abs(stoichiometry) @ ((forces != 0) + np.eye(self.numCompartments)[self.sources_])) != 0
+        rows, cols = np.nonzero(dependence)
+        self.bands_ = (int(np.max(rows - cols, initial=0)), int(np.max(cols - rows, initial=0)))
+
+        useSparse = self.sparseMatrices if self.sparseMatrices is not None else self.numCompartments >= 50
+        self.stoichiometry_ = sparse.csr_matrix(stoichiometry) if useSparse else stoichiometry
+        self.forces_ = sparse.csr_matrix(forces) if useSparse else forces
+        self.compiled_ = True
+
+    def stoichiometry(self):
+        if not self.compiled_:
+            self.compile_()
+        return self.stoichiometry_.toarray() if sparse.issparse(self.stoichiometry_) else self.stoichiometry_
+
+    def sourceIndices(self):
+        if not self.compiled_:
+            self.compile_()
+        return self.sources_
+
+    def flux(self, y):
+        if not self.compiled_:
+            self.compile_()
+        state = np.asarray(y, dtype=float).reshape(self.numCompartments, -1)
+        return self.rates_ * state[self.sources_] * (self.forces_ @ state + self.base_)
+
+    def __call__(self, y, t):
+        flux = self.flux(y)
+        return (self.stoichiometry_ @ flux).reshape(np.shape(y))
+
+    def jacobian(self, y, t):
+        if not self.compiled_:
+            self.compile_()
+        state = np.asarray(y, dtype=float).reshape(self.numCompartments)
+        rates = self.rates_.ravel()
+        sourceRates = (rates * state[self.sources_]).reshape(-1, 1)
+        if sparse.issparse(self.forces_):
+            dFlux = self.forces_.multiply(sourceRates).toarray()
+        else:
+            dFlux = self.forces_ * sourceRates
+        dFlux[np.arange(len(self.flows)), self.sources_] += rates * (self.forces_ @ state + self.base_.ravel())
+        return np.asarray(self.stoichiometry_ @ dFlux)
+
+    @property
+    def jacobianBands(self):
+        if not self.compiled_:
+            self.compile_()
+        return self.bands_
+
+class SweepModel:
+    def __init__(self, modelClass, initialConditions=None, **params):
+        arrays = np.broadcast_arrays(*[np.atleast_1d(np.asarray(v, dtype=float)) for v in params.values()])
+        self.params = {name: np.ravel(a) for name, a in zip(params.keys(), arrays)}
+        self.modelClass = modelClass
+        self.model = modelClass(**self.params)
+        self.numScenarios = len(arrays[0]) if arrays else 1
+        self.numCompartments = self.model.numCompartments
+        self.labels = self.model.labels
+        self.colors = self.model.colors
+
+        # State is laid out scenario-major, (numScenarios, numCompartments) flattened,
+        # so the system Jacobian is block diagonal with half bandwidth numCompartments - 1
+        ic = self.model.initialConditions if initialConditions is None else initialConditions
+        self.initialConditions = np.ravel(np.broadcast_to(np.asarray(ic, dtype=float),
+                                                          (self.numScenarios, self.numCompartments)))
+
+    def __str__(self):
+        return 'Sweep: {} x {}'.format(self.modelClass.__name__, self.numScenarios)
+
+    def __repr__(self):
+        return 'Sweep({}, {})'.format(self.modelClass.__name__, self.numScenarios)
+
+    def parameters(self):
+        return {name: v.tolist() for name, v in self.params.items()}
+
+    def __call__(self, y, t):
+        state = y.reshape(self.numScenarios, self.numCompartments).T
+        return np.stack(self.model(state, t), axis=1).ravel()
+
+    def bandedJacobian(self, y, t):
+        state = y.reshape(self.numScenarios, self.numCompartments).T
+        jac = self.model.jacobian(state, t)
+        band = self.numCompartments - 1
+        banded = np.zeros((2 * band + 1, len(y)))
+        for i in range(self.numCompartments):
+            for j in range(self.numCompartments):
+                banded[i - j + band, j::self.numCompartments] = jac[i, j]
+        return banded
+
+    def scenario(self, i):
+        model = self.modelClass(**{name: float(v[i]) for name, v in self.params.items()})
+        model.initialConditions = tuple(self.initialConditions.reshape(self.numScenarios, -1)[i])
+        return model
+
+class MetapopulationModel:
+    # Regions running copies of model's flows, coupled through a sparse
+    # mobility matrix of travel fractions (row i: fraction of region i's
+    # contacts made in region j). Forces act on the mixed state W @ Y, with
+    # W = mobility off the diagonal and 1 - row sum on it. State is laid out
+    # region-major, (numRegions, numCompartments) flattened, as in SweepModel.
+    def __init__(self, model, mobility, initialConditions=None):
+        self.model = model
+        self.flow = model if isinstance(model, FlowModel) else model.flowModel()
+        self.mobility = sparse.csr_matrix(mobility, dtype=float)
+        self.numRegions = self.mobility.shape[0]
+        self.numCompartments = self.flow.numCompartments
+        self.labels = self.flow.labels
+        self.colors = self.flow.colors
+
+        offDiagonal = self.mobility - sparse.diags(self.mobility.diagonal())
+        self.mixing = (offDiagonal + sparse.diags(1 - np.ravel(offDiagonal.sum(axis=1)))).tocsr()
+
+        stoichiometry = self.flow.stoichiometry()
+        self.stoichiometryT_ = stoichiometry.T
+        self.sources_ = self.flow.sourceIndices()
+        self.rates_ = self.flow.rates_.ravel()
+        self.base_ = self.flow.base_.ravel()
+        forces = self.flow.forces_
+        self.forcesT_ = (forces.toarray() if sparse.issparse(forces) else forces).T
+        self.sourceMatrix_ = np.eye(self.numCompartments)[self.sources_]
+
+        ic = self.flow.initialConditions if initialConditions is None else initialConditions
+        self.initialConditions = np.ravel(np.broadcast_to(np.asarray(ic, dtype=float),
+                                                          (self.numRegions, self.numCompartments)))
+
+    def __str__(self):
+        return 'Metapopulation: {} x {}'.format(self.flow, self.numRegions)
+
+    def __repr__(self):
+        return 'Metapopulation({!r}, {})'.format(self.model, self.numRegions)
+
+    def parameters(self):
+        # Mobility as sparse (row, col, data) triplets; a dense copy would be
+        # numRegions squared entries in every ResultStore index record
+        mobility = self.mobility.tocoo()
+        return {'flows': self.flow.parameters()['flows'],
+                'numRegions': self.numRegions,
+                'mobility': {'row': mobility.row, 'col': mobility.col, 'data': mobility.data}}
+
+    def state_(self, y):
+        return np.asarray(y, dtype=float).reshape(self.numRegions, self.numCompartments)
+
+    def flux(self, y):
+        # (numRegions, numFlows), all regions at once through the sparse mixing product
+        state = self.state_(y)
+        return self.rates_ * state[:, self.sources_] * ((self.mixing @ state) @ self.forcesT_ + self.base_)
+
+    def __call__(self, y, t):
+        return (self.flux(y) @ self.stoichiometryT_).ravel()
+
+    def sparseJacobian(self, y, t):
+        # Block (i, j) is W[i, j] * S diag(rate * Y[i, sources]) F, plus on the
+        # diagonal S diag(rate * force_i) E with E selecting each flow's source
+        state = self.state_(y)
+        C = self.numCompartments
+        stoichiometry = self.stoichiometryT_.T
+        force = (self.mixing @ state) @ self.forcesT_ + self.base_
+        diagonal = np.einsum('ck,ik,kd->icd', stoichiometry, self.rates_ * force, self.sourceMatrix_)
+        coupling = np.einsum('ck,ik,kd->icd', stoichiometry, self.rates_ * state[:, self.sources_], self.forcesT_.T)
+
+        mixing = self.mixing.tocoo()
+        regions = np.arange(self.numRegions)
+        rows, cols = blockIndices_(np.concatenate([mixing.row, regions]), np.concatenate([mixing.col, regions]), C)
+        data = np.concatenate([mixing.data[:, None, None] * coupling[mixing.row], diagonal])
+        size = self.numRegions * C
+        return sparse.csr_matrix((data.ravel(), (rows, cols)), shape=(size, size))
+
+    def components(self):
+        # Independent region blocks: connected components of the mobility graph
+        from scipy.sparse.csgraph import connected_components
+        _, labels = connected_components(self.mobility, directed=True, connection='weak')
+        return [np.nonzero(labels == label)[0] for label in np.unique(labels)]
+
+    def regions(self, indices):
+        return MetapopulationModel(self.flow,
+                                   self.mobility[indices][:, indices],
+                                   self.state_(self.initialConditions)[indices])
+
+def blockIndices_(rowBlocks, colBlocks, size):
+    # Flattened (row, col) indices of size x size blocks at the given block positions
+    block = np.arange(size)
+    shape = (len(rowBlocks), size, size)
+    rows = np.broadcast_to(rowBlocks[:, None, None] * size + block[None, :, None], shape)
+    cols = np.broadcast_to(colBlocks[:, None, None] * size + block[None, None, :], shape)
+    return rows.ravel(), cols.ravel()
+
+class ModelBatch:
+    # Columnar scenario list: one structured array row per scenario, with a
+    # field per model parameter plus initialConditions. Models are built only
+    # when indexed; slices stay batches and sweep() solves them all at once.
+    def __init__(self, modelClass, initialConditions=None, **params):
+        default = modelClass()
+        unknown = [name for name in params if name not in default.parameters()]
+        if unknown:
+            raise(EpidemicException(
+                "ModelBatch: unknown parameters ({}) for {}".format(', '.join(unknown), modelClass.__name__)))
+
+        columns = {name: np.atleast_1d(np.asarray(params.get(name, value), dtype=float))
+                   for name, value in default.parameters().items()}
+        ic = default.initialConditions if initialConditions is None else initialConditions
+        ic = np.atleast_2d(np.asarray(ic, dtype=float))
+        size = np.broadcast_shapes(*[c.shape for c in columns.values()], ic.shape[:1])[0]
+
+        self.modelClass = modelClass
+        self.data = np.empty(size, dtype=[(name, float) for name in columns] +
+                                        [('initialConditions', float, (default.numCompartments,))])
+        for name, column in columns.items():
+            self.data[name] = column
+        self.data['initialConditions'] = ic
+
+    @classmethod
+    def fromData(cls, modelClass, data):
+        batch = cls.__new__(cls)
+        batch.modelClass = modelClass
+        batch.data = data
+        return batch
+
+    @classmethod
+    def fromModels(cls, models):
+        models = list(models)
+        modelClass = type(models[0])
+        return cls(modelClass,
+                   initialConditions=[model.initialConditions for model in models],
+                   **{name: [model.parameters()[name] for model in models]
+                      for name in models[0].parameters()})
+
+    def __str__(self):
+        return 'Batch: {} x {}'.format(self.modelClass.__name__, len(self))
+
+    def __repr__(self):
+        return 'Batch({}, {})'.format(self.modelClass.__name__, len(self))
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return self.model(index)
+        return ModelBatch.fromData(self.modelClass, self.data[index])
+
+    def __iter__(self):
+        return (self.model(i) for i in range(len(self)))
+
+    def names(self):
+        return [name for name in self.data.dtype.names if name != 'initialConditions']
+
+    def parameters(self):
+        return {name: self.data[name].tolist() for name in self.names()}
+
+    def model(self, i):
+        row = self.data[i]
+        model = self.modelClass(**{name: float(row[name]) for name in self.names()})
+        model.initialConditions = tuple(row['initialConditions'].tolist())
+        return model
+
+    def sweep(self):
+        return SweepModel(self.modelClass,
+                          initialConditions=self.data['initialConditions'],
+                          **{name: self.data[name] for name in self.names()})
+
+class ThresholdEvent:
+    def __init__(self, label, threshold, direction=-1, terminal=True):
+        self.label = label
+        self.threshold = threshold
+        self.direction = direction
+        self.terminal = terminal
+
+    def __str__(self):
+        return 'ThresholdEvent({}, {})'.format(self.label, self.threshold)
+
+    def __repr__(self):
+        return str(self)
+
+    def bind(self, model):
+        index = model.labels.index(self.label)
+        def event(t, y):
+            return y[index] - self.threshold
+        event.direction = self.direction
+        event.terminal = self.terminal
+        return event
+
+class PeakEvent:
+    def __init__(self, label, terminal=False):
+        self.label = label
+        self.terminal = terminal
+
+    def __str__(self):
+        return 'PeakEvent({})'.format(self.label)
+
+    def __repr__(self):
+        return str(self)
+
+    def bind(self, model):
+        # Peak is where the compartment's derivative crosses zero from above
+        index = model.labels.index(self.label)
+        def event(t, y):
+            return model(y, t)[index]
+        event.direction = -1
+        event.terminal = self.terminal
+        return event
+
+class EventResult:
+    def __init__(self, event, index, times, states):
+        self.event = event
+        self.times = times
+        self.states = states
+        self.values = states[:, index] if len(states) else np.empty(0)
+
+    def __str__(self):
+        return '{}: times={} values={}'.format(self.event, self.times, self.values)
+
+    def __repr__(self):
+        return str(self)
+
+def solve(model=SIRModel(),
+          maxTime=10,
+          timeSteps=100,
+          jacobian=True,
+          banded=False,
+          method='odeint',
+          rtol=None,
+          atol=None,
+          profile=None,
+          substeps=1):
+    # substeps sets rk4's fixed steps per output interval
     t = np.linspace(0, maxTime, timeSteps)
-    sir = odeint(model, model.initialConditions, t)
+    sir = integ.integrate(model,
+                          model.initialConditions,
+                          t,
+                          method=method,
+                          rtol=rtol,
+                          atol=atol,
+                          substeps=substeps,
+                          jacobianArgs=util.jacobianArgs(model, jacobian, banded),
+                          breakpoints=breakpoints_(model),
+                          profile=profile)
     return t, sir
 
+def breakpoints_(model):
+    return model.breakpoints() if hasattr(model, 'breakpoints') else ()
+
+def solveEvents(model, events, maxTime=10, timeSteps=100, chunkSize=None, jacobian=True, banded=False):
+    # Streams the solve() grid, looks for sign changes of each event function
+    # between grid points and refines them by root finding on short odeint
+    # restarts. Integration stops at the first terminal event, checked after
+    # every chunk, by default a tenth of the grid.
+    from scipy.optimize import brentq
+    chunkSize = max(1, timeSteps // 10) if chunkSize is None else chunkSize
+    args = util.jacobianArgs(model, jacobian, banded)
+    breakpoints = breakpoints_(model)
+    ftns = [event.bind(model) for event in events]
+    found = [([], []) for _ in events]
+    ts, ys = [], []
+    tPrev, yPrev = None, None
+    for t, y in solveStream(model, maxTime, timeSteps, chunkSize, jacobian, banded):
+        tw = t if tPrev is None else np.concatenate(([tPrev], t))
+        yw = y if yPrev is None else np.concatenate(([yPrev], y))
+
+        crossings = []
+        for e, ftn in enumerate(ftns):
+            # Per grid point: models and schedules may branch on a scalar t
+            g = np.array([ftn(ti, yi) for ti, yi in zip(tw, yw)])
+            for k in np.nonzero(crossed_(g, ftn.direction))[0]:
+                crossings.append((k, e))
+
+        # Events are kept only once the stop time is known: a terminal event
+        # refined later in the same interval may stop integration earlier
+        stop = None
+        refined = []
+        for k, e in sorted(crossings):
+            if stop is not None and k > stop[0]:
+                break
+            ftn = ftns[e]
+            y0 = yw[k]
+            stateAt = lambda tau: (integ.integrate(model, y0, [tw[k], tau], jacobianArgs=args, breakpoints=breakpoints)[-1]
+                                   if tau > tw[k] else y0)
+            tEvent = brentq(lambda tau: ftn(tau, stateAt(tau)), tw[k], tw[k + 1], xtol=1e-12)
+            refined.append((tEvent, e, stateAt(tEvent)))
+            if ftn.terminal and (stop is None or tEvent < stop[1]):
+                stop = (k, tEvent)
+        for tEvent, e, yEvent in sorted(refined, key=lambda event: event[0]):
+            if stop is None or tEvent <= stop[1]:
+                found[e][0].append(tEvent)
+                found[e][1].append(yEvent)
+
+        if stop is not None:
+            keep = t <= stop[1]
+            ts.append(t[keep])
+            ys.append(y[keep])
+            break
+        ts.append(t)
+        ys.append(y)
+        tPrev, yPrev = t[-1], y[-1]
+
+    results = [EventResult(event,
+                           model.labels.index(event.label),
+                           np.array(times),
+                           np.array(states).reshape(len(times), model.numCompartments))
+               for event, (times, states) in zip(events, found)]
+    return np.concatenate(ts), np.concatenate(ys), results
+
+def crossed_(g, direction):
+    rising = (g[:-1] < 0) & (g[1:] >= 0)
+    falling = (g[:-1] > 0) & (g[1:] <= 0)
+    if direction > 0:
+        return rising
+    if direction < 0:
+        return falling
+    return rising | falling
+
+def solveStream(model=SIRModel(), maxTime=10, timeSteps=100, chunkSize=1000, jacobian=True, banded=False):
+    # Yields (t, ys) blocks of at most chunkSize points on the same grid as
+    # solve(), restarting odeint from the last state of the previous block
+    step = maxTime / (timeSteps - 1) if timeSteps > 1 else 0.0
+    args = util.jacobianArgs(model, jacobian, banded)
+    breakpoints = breakpoints_(model)
+    y0 = model.initialConditions
+    for start in range(0, timeSteps, chunkSize):
+        stop = min(start + chunkSize, timeSteps)
+        t = np.arange(start, stop) * step
+        if stop == timeSteps and timeSteps > 1:
+            t[-1] = maxTime
+        if start == 0:
+            ys = integ.integrate(model, y0, t, jacobianArgs=args, breakpoints=breakpoints)
+        else:
+            ys = integ.integrate(model, y0, np.concatenate(([tLast], t)), jacobianArgs=args, breakpoints=breakpoints)[1:]
+        y0 = ys[-1]
+        tLast = t[-1]
+        yield t, ys
+
+def solveSweep(model, maxTime=10, timeSteps=100, jacobian=True, method='odeint', rtol=None, atol=None, profile=None,
+               substeps=1):
+    t = np.linspace(0, maxTime, timeSteps)
+    band = model.numCompartments - 1
+    Dfun = model.bandedJacobian if jacobian else None
+    ys = integ.integrate(model,
+                         model.initialConditions,
+                         t,
+                         method=method,
+                         rtol=rtol,
+                         atol=atol,
+                         substeps=substeps,
+                         jacobianArgs={'Dfun': Dfun, 'ml': band, 'mu': band},
+                         profile=profile)
+    return t, ys.reshape(timeSteps, model.numScenarios, model.numCompartments).transpose(1, 0, 2)
+
+def solveMetapopulation(model, maxTime=10, timeSteps=100, method='odeint', rtol=None, atol=None, maxWorkers=1):
+    # Returns t and ys shaped (timeSteps, numRegions, numCompartments). With
+    # maxWorkers other than 1, unconnected region blocks are solved in parallel
+    # through ScenarioRunner. Radau/BDF use the sparse Jacobian.
+    components = model.components()
+    if len(components) > 1 and maxWorkers != 1:
+        import math_models_runner as runner
+        scenarios = [runner.Scenario(solveMetapopulation, model.regions(indices), maxTime, timeSteps, method, rtol, atol)
+                     for indices in components]
+        ys = np.empty((timeSteps, model.numRegions, model.numCompartments))
+        for indices, (t, block) in zip(components, runner.ScenarioRunner(maxWorkers=maxWorkers).run(scenarios)):
+            ys[:, indices] = block
+        return t, ys
+
+    t = np.linspace(0, maxTime, timeSteps)
+    ys = integ.integrate(model,
+                         model.initialConditions,
+                         t,
+                         method=method,
+                         rtol=rtol,
+                         atol=atol,
+                         jacobianArgs={'Dfun': model.sparseJacobian} if method in ('Radau', 'BDF') else None)
+    return t, ys.reshape(timeSteps, model.numRegions, model.numCompartments)
+
 def plotFinish_(title, legend=None):
+    import matplotlib.pyplot as plt
     plt.xlabel('Time')
     plt.ylabel('Population')
     plt.title(title)
@@ -101,16 +828,37 @@ def plotFinish_(title, legend=None):
     plt.grid()
     plt.show()
 
-def plot(model, t, ys):
+def plot(model, t, ys, bands=None, maxPoints=10000):
+    # bands is an optional (lower, upper) pair shaped like ys, e.g. EnsembleStats.band().
+    # Longer series are downsampled to about maxPoints keeping bucket extremes.
+    import matplotlib.pyplot as plt
+    series = [ys] if bands is None else [ys, bands[0], bands[1]]
+    t, series = util.downsample(t, [y for s in series for y in np.asarray(s).T], maxPoints)
+    ys = np.transpose(series[:model.numCompartments])
+    if bands is not None:
+        bands = (np.transpose(series[model.numCompartments:2 * model.numCompartments]),
+                 np.transpose(series[2 * model.numCompartments:]))
     for i in range(model.numCompartments):
         plt.plot(t, ys[:, i], color=model.colors[i], label=model.labels[i])
+        if bands is not None:
+            plt.fill_between(t, bands[0][:, i], bands[1][:, i], color=model.colors[i], alpha=0.2)
 
     plotFinish_('{}'.format(model), legend='best')
 
-def animate(model, t, ys, legend=None):
+def animate(model, t, ys, legend=None, filename=None, maxFrames=None, maxPoints=None):
+    import math_models_animate as anim
     animation = anim.Animate(t,
                              [ys[:, i] for i in range(model.numCompartments)],
                              labels=model.labels,
-                             colors=model.colors)
+                             colors=model.colors,
+                             maxPoints=maxPoints)
+    if filename is not None:
+        animation.save(filename,
+                       maxFrames=maxFrames,
+                       title='{}'.format(model),
+                       legend=legend,
+                       xlabel='Time',
+                       ylabel='Population')
+        return
     animation.run(interval=25)
     plotFinish_('{}'.format(model), legend=legend)
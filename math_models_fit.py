@@ -0,0 +1,188 @@
+import numpy as np
+from scipy.optimize import least_squares
+import math_models_epidemic as epidemic
+import math_models_integrate as integ
+import math_models_population as population
+import math_models_runner as runner
+
+class FitException(Exception):
+    pass
+
+class FitProblem:
+    # Least squares calibration of named model parameters to observations y at
+    # times t. Every evaluation solves a batch of parameter sets as one system,
+    # a SweepModel for epidemic models and a vector LogisticModel for population
+    # models, so the forward difference Jacobian costs one solve, not one per
+    # parameter. NaN observations are ignored.
+    def __init__(self, model, t, y, names, labels=None, relativeStep=1e-5, method='odeint', tolerance=1e-10):
+        self.model = model
+        self.names = list(names)
+        self.labels = labels
+        self.relativeStep = relativeStep
+        self.method = method
+        self.tolerance = tolerance
+        self.upper_ = np.inf
+
+        current = self.current_()
+        unknown = [name for name in self.names if name not in current]
+        if unknown:
+            raise(FitException(
+                "FitProblem: unknown parameters ({}) - expected some of {}".format(
+                    ', '.join(unknown), ', '.join(current))))
+
+        self.t = np.asarray(t, dtype=float)
+        if self.t.ndim != 1 or np.any(self.t < 0) or np.any(np.diff(self.t) <= 0):
+            raise(FitException("FitProblem: observation times must be increasing and non-negative"))
+        self.columns = self.columns_()
+        self.y = np.asarray(y, dtype=float).reshape(len(self.t), len(self.columns))
+        self.mask = np.isfinite(self.y)
+
+        # Solves start at 0; observations are read off the tail of the grid
+        self.grid = self.t if self.t[0] == 0 else np.concatenate(([0.0], self.t))
+        self.offset = len(self.grid) - len(self.t)
+
+    def __str__(self):
+        return 'FitProblem({}, {})'.format(self.model, ', '.join(self.names))
+
+    def __repr__(self):
+        return str(self)
+
+    def x0(self):
+        current = self.current_()
+        return np.array([current[name] for name in self.names], dtype=float)
+
+    def modelAt(self, x):
+        values = dict(zip(self.names, (float(v) for v in x)))
+        if isinstance(self.model, population.LogisticModel):
+            return population.LogisticModel(values.get('rate', self.model.rate),
+                                            values.get('population0', self.model.population0),
+                                            self.model.capacity)
+        model = type(self.model)(**{**self.model.parameters(), **values})
+        model.initialConditions = self.model.initialConditions
+        return model
+
+    def trajectories(self, xs):
+        # Observed columns for each row of xs, shaped (len(xs), len(t), len(columns))
+        xs = np.atleast_2d(np.asarray(xs, dtype=float))
+        values = dict(zip(self.names, xs.T))
+        if isinstance(self.model, population.LogisticModel):
+            ys = self.logistic_(values)[..., np.newaxis]
+        else:
+            ys = self.sweep_(values)
+        return ys[:, self.offset:, self.columns]
+
+    def residuals(self, x):
+        return (self.trajectories(x)[0] - self.y)[self.mask]
+
+    def jacobian(self, x):
+        # Base and every perturbed parameter set in one batched solve; steps
+        # flip sign rather than leave the bounds
+        x = np.asarray(x, dtype=float)
+        h = self.relativeStep * np.maximum(np.abs(x), 1.0)
+        h = np.where(x + h > self.upper_, -h, h)
+        ys = self.trajectories(np.vstack([x, x + np.diag(h)]))
+        return np.stack([((y - ys[0]) / hj)[self.mask] for y, hj in zip(ys[1:], h)], axis=1)
+
+    def solve(self, x0, bounds=(0, np.inf), **kwargs):
+        # Returns (x, [cost, nfev, njev]) so restarts can travel through ScenarioRunner
+        self.upper_ = np.broadcast_to(np.asarray(bounds[1], dtype=float), np.shape(x0))
+        result = least_squares(self.residuals, x0, jac=self.jacobian, bounds=bounds, **kwargs)
+        return result.x, np.array([result.cost, result.nfev, result.njev or 0], dtype=float)
+
+    def current_(self):
+        parameters = self.model.parameters()
+        return {name: value for name, value in parameters.items() if np.isscalar(value) and not isinstance(value, str)}
+
+    def columns_(self):
+        if isinstance(self.model, population.LogisticModel):
+            return [0]
+        labels = self.model.labels if self.labels is None else self.labels
+        missing = [label for label in labels if not self.model.hasLabel(label)]
+        if missing:
+            raise(FitException(
+                "FitProblem: unknown labels ({}) - expected some of {}".format(
+                    ', '.join(missing), ', '.join(self.model.labels))))
+        return [self.model.labels.index(label) for label in labels]
+
+    def sweep_(self, values):
+        sweep = epidemic.SweepModel(type(self.model),
+                                    initialConditions=self.model.initialConditions,
+                                    **{**self.model.parameters(), **values})
+        band = sweep.numCompartments - 1
+        ys = integ.integrate(sweep,
+                             sweep.initialConditions,
+                             self.grid,
+                             method=self.method,
+                             rtol=self.tolerance,
+                             atol=self.tolerance,
+                             jacobianArgs={'Dfun': sweep.bandedJacobian, 'ml': band, 'mu': band})
+        return ys.reshape(len(self.grid), sweep.numScenarios, sweep.numCompartments).transpose(1, 0, 2)
+
+    def logistic_(self, values):
+        rate, population0 = np.broadcast_arrays(np.asarray(values.get('rate', self.model.rate), dtype=float),
+                                                np.asarray(values.get('population0', self.model.population0), dtype=float))
+        model = population.LogisticModel(rate, population0, self.model.capacity)
+        # Independent scenarios, so the Jacobian is diagonal
+        Dfun = lambda p, t: (rate * (1 - 2 * p / model.capacity(t)))[np.newaxis]
+        ps = integ.integrate(model,
+                             np.array(population0, dtype=float),
+                             self.grid,
+                             method=self.method,
+                             rtol=self.tolerance,
+                             atol=self.tolerance,
+                             jacobianArgs={'Dfun': Dfun, 'ml': 0, 'mu': 0})
+        return ps.T
+
+class FitResult:
+    def __init__(self, problem, starts, fits):
+        self.names = problem.names
+        self.starts = np.array(starts)
+        self.xs = np.array([x for x, _ in fits])
+        self.costs = np.array([info[0] for _, info in fits])
+        best = int(np.argmin(self.costs))
+        self.x = self.xs[best]
+        self.cost = self.costs[best]
+        self.nfev = int(sum(info[1] for _, info in fits))
+        self.model = problem.modelAt(self.x)
+
+    def __str__(self):
+        return 'FitResult({}, cost={})'.format(
+            ', '.join('{}={}'.format(name, v) for name, v in zip(self.names, self.x)),
+            self.cost)
+
+    def __repr__(self):
+        return str(self)
+
+    def parameters(self):
+        return {name: float(v) for name, v in zip(self.names, self.x)}
+
+def startPoints(x0, restarts, bounds=(0, np.inf), spread=4.0, seed=None):
+    # x0 first, then log-uniform draws within a factor of spread of x0
+    rng = np.random.default_rng(seed)
+    x0 = np.asarray(x0, dtype=float)
+    draws = x0 * np.exp(rng.uniform(-np.log(spread), np.log(spread), (restarts - 1, len(x0))))
+    return np.vstack([x0, np.clip(draws, bounds[0], bounds[1])])
+
+def fit(model,
+        t,
+        y,
+        names,
+        labels=None,
+        bounds=(0, np.inf),
+        restarts=1,
+        spread=4.0,
+        seed=None,
+        maxWorkers=None,
+        **kwargs):
+    # Restarts run in parallel through ScenarioRunner unless maxWorkers is 1
+    problem = FitProblem(model, t, y, names, labels=labels)
+    starts = startPoints(problem.x0(), restarts, bounds, spread, seed)
+    scenarios = [runner.Scenario(solveStart_, problem, x0, bounds, **kwargs) for x0 in starts]
+    if len(scenarios) > 1 and maxWorkers != 1:
+        fits = runner.ScenarioRunner(maxWorkers=maxWorkers, chunkSize=1).run(scenarios)
+    else:
+        fits = [scenario() for scenario in scenarios]
+    return FitResult(problem, starts, fits)
+
+def solveStart_(problem, x0, bounds, **kwargs):
+    return problem.solve(x0, bounds, **kwargs)
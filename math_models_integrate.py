@@ -0,0 +1,317 @@
+import time
+import numpy as np
+from scipy import sparse
+from scipy.integrate import odeint, solve_ivp
+import math_models_util as util
+
+class IntegrateException(Exception):
+    pass
+
+ivpMethods = ('RK45', 'RK23', 'DOP853', 'Radau', 'BDF', 'LSODA')
+methods = ('odeint', 'rk4', 'dopri5') + ivpMethods
+
+# odeint's default tolerances, used for every adaptive method unless given
+defaultTolerance = 1.49012e-8
+
+def integrate(ftn,
+              y0,
+              t,
+              method='odeint',
+              rtol=None,
+              atol=None,
+              jacobianArgs=None,
+              substeps=1,
+              breakpoints=(),
+              profile=None,
+              info=None):
+    # ftn(y, t) -> dy/dt in odeint's argument order. Returns y at each t,
+    # shaped (len(t),) + shape(y0). Integration restarts at each breakpoint
+    # inside t so no step straddles a jump in ftn. A SolveProfile collects
+    # call counts, timings and integrator diagnostics; info, if a list,
+    # receives the integrator's own diagnostics dicts.
+    if profile is not None:
+        return profile.integrate(ftn, y0, t, method, rtol, atol, jacobianArgs, substeps, breakpoints)
+
+    jacobianArgs = jacobianArgs or {}
+    breakpoints = np.asarray(breakpoints, dtype=float)
+    breakpoints = breakpoints[(breakpoints > t[0]) & (breakpoints < t[-1])]
+    if len(breakpoints):
+        return segments_(ftn, y0, t, breakpoints, method, rtol, atol, jacobianArgs, substeps, info)
+    if method == 'odeint':
+        y0 = np.asarray(y0, dtype=float)
+        if y0.ndim == 1:
+            return odeint_(ftn, y0, t, rtol, atol, info, **jacobianArgs)
+        ys = odeint_(lambda y, ti: np.ravel(ftn(y.reshape(y0.shape), ti)), np.ravel(y0), t, rtol, atol, info)
+        return ys.reshape((len(t),) + y0.shape)
+    if method == 'rk4':
+        return rk4(ftn, y0, t, substeps=substeps)
+
+    rtol = defaultTolerance if rtol is None else rtol
+    atol = defaultTolerance if atol is None else atol
+    if method == 'dopri5':
+        return dopri5(ftn, y0, t, rtol=rtol, atol=atol)
+    if method in ivpMethods:
+        return ivp_(ftn, y0, t, method, rtol, atol, jacobianArgs, info)
+
+    raise(IntegrateException(
+        "integrate: invalid method ({}) - expected one of {}".format(method, ', '.join(methods))))
+
+def odeint_(ftn, y0, t, rtol, atol, info, **jacobianArgs):
+    if info is None:
+        return odeint(ftn, y0, t, rtol=rtol, atol=atol, **jacobianArgs)
+    ys, out = odeint(ftn, y0, t, rtol=rtol, atol=atol, full_output=True, **jacobianArgs)
+    info.append(out)
+    return ys
+
+def segments_(ftn, y0, t, breakpoints, method, rtol, atol, jacobianArgs, substeps, info):
+    # Piecewise functions take the left value at a limit, so each segment after
+    # the first starts one ulp past its breakpoint to see the new value
+    y = np.asarray(y0, dtype=float)
+    ys = np.empty((len(t),) + y.shape)
+    start = t[0]
+    i = 0
+    for end in np.append(breakpoints, t[-1]):
+        j = np.searchsorted(t, end, side='right')
+        grid = np.unique(np.concatenate(([start], t[i:j], [end])))
+        segment = integrate(ftn, y, grid, method, rtol, atol, jacobianArgs, substeps, info=info)
+        ys[i:j] = segment[np.searchsorted(grid, t[i:j])]
+        y = segment[-1]
+        start = np.nextafter(end, np.inf)
+        i = j
+    return ys
+
+def ivp_(ftn, y0, t, method, rtol, atol, jacobianArgs, info=None):
+    # Implicit methods take the Jacobian, banded ones included: LSODA reads
+    # odeint's packed band storage as is, Radau and BDF get it unpacked into
+    # a sparse matrix, or just its band pattern when there is no Dfun, so
+    # a stacked sweep never falls back to a dense finite difference Jacobian
+    options = {}
+    Dfun = jacobianArgs.get('Dfun')
+    ml, mu = jacobianArgs.get('ml'), jacobianArgs.get('mu')
+    if method == 'LSODA':
+        if ml is not None:
+            options['lband'], options['uband'] = ml, mu
+        if Dfun is not None:
+            options['jac'] = lambda ti, y: Dfun(y, ti)
+    elif method in ('Radau', 'BDF'):
+        n = np.size(y0)
+        offsets = mu - np.arange(ml + mu + 1) if ml is not None else None
+        if Dfun is not None and ml is not None:
+            options['jac'] = lambda ti, y: sparse.dia_matrix((Dfun(y, ti), offsets), shape=(n, n)).tocsc()
+        elif Dfun is not None:
+            options['jac'] = lambda ti, y: Dfun(y, ti)
+        elif ml is not None:
+            options['jac_sparsity'] = sparse.diags([np.ones(n - abs(k)) for k in offsets], offsets, shape=(n, n))
+
+    y0 = np.asarray(y0, dtype=float)
+    sol = solve_ivp(lambda ti, y: np.ravel(ftn(y, ti)),
+                    (t[0], t[-1]),
+                    np.ravel(y0),
+                    method=method,
+                    t_eval=t,
+                    rtol=rtol,
+                    atol=atol,
+                    **options)
+    if not sol.success:
+        raise(IntegrateException("integrate: {} failed - {}".format(method, sol.message)))
+    if info is not None:
+        info.append({'nfe': [sol.nfev], 'nje': [sol.njev]})
+    return sol.y.T.reshape((len(t),) + y0.shape)
+
+def derivative_(ftn, y, t):
+    return np.asarray(ftn(y, t), dtype=float).reshape(y.shape)
+
+def rk4(ftn, y0, t, substeps=1):
+    # Classic fixed-step Runge-Kutta, substeps steps between output times.
+    # y may be any array shape, e.g. (compartments, scenarios).
+    y = np.array(y0, dtype=float)
+    ys = np.empty((len(t),) + y.shape)
+    ys[0] = y
+    for i in range(1, len(t)):
+        h = (t[i] - t[i - 1]) / substeps
+        ti = t[i - 1]
+        for _ in range(substeps):
+            k1 = derivative_(ftn, y, ti)
+            k2 = derivative_(ftn, y + h / 2 * k1, ti + h / 2)
+            k3 = derivative_(ftn, y + h / 2 * k2, ti + h / 2)
+            k4 = derivative_(ftn, y + h * k3, ti + h)
+            y = y + h / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+            ti += h
+        ys[i] = y
+    return ys
+
+# Dormand-Prince 5(4) tableau
+dopriC = np.array([0, 1 / 5, 3 / 10, 4 / 5, 8 / 9, 1, 1])
+dopriA = [[],
+          [1 / 5],
+          [3 / 40, 9 / 40],
+          [44 / 45, -56 / 15, 32 / 9],
+          [19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729],
+          [9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656],
+          [35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84]]
+dopriE = np.array([71 / 57600, 0, -71 / 16695, 71 / 1920, -17253 / 339200, 22 / 525, -1 / 40])
+
+def dopri5(ftn, y0, t, rtol=defaultTolerance, atol=defaultTolerance, maxSteps=100000):
+    # Embedded Dormand-Prince with one step size shared by the whole state
+    # array; steps are shortened to land exactly on each output time. The
+    # error is a max norm, so in a batched state the least settled scenario
+    # sets the step rather than being averaged down by quiet ones.
+    y = np.array(y0, dtype=float)
+    ys = np.empty((len(t),) + y.shape)
+    ys[0] = y
+    ti = t[0]
+    f = derivative_(ftn, y, ti)
+    h = initialStep_(y, f, rtol, atol, t[-1] - t[0])
+    steps = 0
+    for i in range(1, len(t)):
+        while ti < t[i]:
+            steps += 1
+            if steps > maxSteps:
+                raise(IntegrateException("dopri5: exceeded maxSteps ({}) before t={}".format(maxSteps, t[i])))
+
+            step = min(h, t[i] - ti)
+            k = [f]
+            for c, a in zip(dopriC[1:], dopriA[1:]):
+                k.append(derivative_(ftn, y + step * sum(aj * kj for aj, kj in zip(a, k) if aj), ti + c * step))
+
+            yNew = y + step * sum(aj * kj for aj, kj in zip(dopriA[6], k) if aj)
+            scale = atol + rtol * np.maximum(np.abs(y), np.abs(yNew))
+            error = np.max(np.abs(step * sum(e * kj for e, kj in zip(dopriE, k) if e) / scale))
+            factor = 5.0 if error == 0 else min(5.0, max(0.2, 0.9 * error ** -0.2))
+            if error <= 1:
+                ti = t[i] if step == t[i] - ti else ti + step
+                y = yNew
+                f = k[6]
+                h = step * factor if step == h else max(h, step * factor)
+            else:
+                h = step * factor
+        ys[i] = y
+    return ys
+
+def initialStep_(y, f, rtol, atol, span):
+    scale = atol + rtol * np.abs(y)
+    d0 = np.sqrt(np.mean((y / scale) ** 2))
+    d1 = np.sqrt(np.mean((f / scale) ** 2))
+    h = 1e-6 if d0 < 1e-5 or d1 < 1e-5 else 0.01 * d0 / d1
+    return min(h, abs(span)) if span else h
+
+class SolveProfile:
+    # Opt-in instrumentation, passed as profile= to integrate() or a solve().
+    # One profile accumulates over any number of solves; add() merges profiles
+    # from separate runs. Step, Jacobian and method switch counts come from
+    # odeint's full_output (nst, nje, mused), others from the wrapped callables.
+    def __init__(self):
+        self.solves = 0
+        self.elapsed = 0.0
+        self.rhsCalls = 0
+        self.rhsTime = 0.0
+        self.jacobianCalls = 0
+        self.jacobianTime = 0.0
+        self.steps = 0
+        self.integratorRhsCalls = 0
+        self.integratorJacobians = 0
+        self.methodSwitches = 0
+        self.stiffOutputs = 0
+        self.timed = []
+        self.merged_ = {}
+
+    def __str__(self):
+        rows = ['solves={} elapsed={:.6f}'.format(self.solves, self.elapsed),
+                'rhs calls={} time={:.6f}'.format(self.rhsCalls, self.rhsTime),
+                'jacobian calls={} time={:.6f}'.format(self.jacobianCalls, self.jacobianTime),
+                'steps={} nfe={} nje={} switches={} stiffOutputs={}'.format(self.steps,
+                                                                           self.integratorRhsCalls,
+                                                                           self.integratorJacobians,
+                                                                           self.methodSwitches,
+                                                                           self.stiffOutputs)]
+        rows.extend('{} calls={} time={:.6f}'.format(name, stats['calls'], stats['elapsed'])
+                    for name, stats in self.callables().items())
+        return '\n'.join(rows)
+
+    def __repr__(self):
+        return 'SolveProfile({}, {:.6f})'.format(self.solves, self.elapsed)
+
+    def track(self, name, ftn):
+        # Returns ftn wrapped in a TimedFtn; callables() totals them by name
+        timed = util.TimedFtn(ftn, name)
+        self.timed.append(timed)
+        return timed
+
+    def callables(self):
+        totals = {name: dict(stats) for name, stats in self.merged_.items()}
+        for timed in self.timed:
+            stats = totals.setdefault(timed.name, {'calls': 0, 'elapsed': 0.0})
+            stats['calls'] += timed.calls
+            stats['elapsed'] += timed.elapsed
+        return totals
+
+    def add(self, other):
+        # other is a SolveProfile or its stats(), e.g. sent back by a
+        # ScenarioRunner worker; its current totals are added
+        stats = other if isinstance(other, dict) else other.stats()
+        for name in ('solves', 'elapsed', 'rhsCalls', 'rhsTime', 'jacobianCalls', 'jacobianTime', 'steps',
+                     'integratorRhsCalls', 'integratorJacobians', 'methodSwitches', 'stiffOutputs'):
+            setattr(self, name, getattr(self, name) + stats[name])
+        for name, callStats in stats['callables'].items():
+            merged = self.merged_.setdefault(name, {'calls': 0, 'elapsed': 0.0})
+            merged['calls'] += callStats['calls']
+            merged['elapsed'] += callStats['elapsed']
+        return self
+
+    def stats(self):
+        return {'solves': self.solves,
+                'elapsed': self.elapsed,
+                'rhsCalls': self.rhsCalls,
+                'rhsTime': self.rhsTime,
+                'jacobianCalls': self.jacobianCalls,
+                'jacobianTime': self.jacobianTime,
+                'steps': self.steps,
+                'integratorRhsCalls': self.integratorRhsCalls,
+                'integratorJacobians': self.integratorJacobians,
+                'methodSwitches': self.methodSwitches,
+                'stiffOutputs': self.stiffOutputs,
+                'callables': self.callables()}
+
+    def integrate(self, ftn, y0, t, method='odeint', rtol=None, atol=None, jacobianArgs=None, substeps=1, breakpoints=()):
+        def rhs(y, ti):
+            start = time.perf_counter()
+            try:
+                return ftn(y, ti)
+            finally:
+                self.rhsTime += time.perf_counter() - start
+                self.rhsCalls += 1
+
+        jacobianArgs = dict(jacobianArgs or {})
+        Dfun = jacobianArgs.get('Dfun')
+        if Dfun is not None:
+            def jacobian(y, ti):
+                start = time.perf_counter()
+                try:
+                    return Dfun(y, ti)
+                finally:
+                    self.jacobianTime += time.perf_counter() - start
+                    self.jacobianCalls += 1
+            jacobianArgs['Dfun'] = jacobian
+
+        info = []
+        start = time.perf_counter()
+        try:
+            return integrate(rhs, y0, t, method, rtol, atol, jacobianArgs, substeps, breakpoints, info=info)
+        finally:
+            self.elapsed += time.perf_counter() - start
+            self.solves += 1
+            for out in info:
+                self.record_(out)
+
+    def record_(self, out):
+        # odeint reports cumulative counts and the method in use per output
+        # time; LSODA always starts non-stiff (Adams, mused 1)
+        if len(out.get('nst', [])):
+            self.steps += int(out['nst'][-1])
+        if len(out['nfe']):
+            self.integratorRhsCalls += int(out['nfe'][-1])
+        if len(out['nje']):
+            self.integratorJacobians += int(out['nje'][-1])
+        mused = np.asarray(out.get('mused', []))
+        self.methodSwitches += int(np.count_nonzero(np.diff(np.concatenate(([1], mused)))) if len(mused) else 0)
+        self.stiffOutputs += int(np.count_nonzero(mused == 2))
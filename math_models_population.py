@@ -1,9 +1,10 @@
 import numpy as np
-from scipy.integrate import odeint
-import matplotlib.pyplot as plt
-import math_models_animate as anim
+import math_models_integrate as integ
 import math_models_util as util
 
+# matplotlib and math_models_animate are imported inside plot/animate so
+# solve-only workloads do not load them
+
 class Dimension(util.SumCallablesFtn):
     def __init__(self, name, factors):
         super().__init__(factors)
@@ -23,7 +24,74 @@ class CarryingCapacity:
     def __repr__(self):
         return str(self)
 
+    def dimensions(self):
+        return self.minDimFtn.callables
+
+    def compile(self):
+        if not all(isCompilable_(dim) for dim in self.dimensions()):
+            return self
+        return CompiledCarryingCapacity(self)
+
+class CompiledCarryingCapacity:
+    vectorized = True
+
+    def __init__(self, capacity):
+        self.capacity0 = capacity.capacity0
+        dims = capacity.dimensions()
+
+        poly, exp, steps = [], [], []
+        self.base = np.zeros(len(dims))
+        for d, dim in enumerate(dims):
+            for f in dim.callables:
+                if isinstance(f, util.PolyChangeFtn):
+                    poly.append((d, f.m, f.s))
+                elif isinstance(f, util.ExpChangeFtn):
+                    exp.append((d, f.m, f.s))
+                else:
+                    # Piecewise constant as values[0] plus a step of
+                    # (values[i + 1] - values[i]) for each x > limits[i]
+                    self.base[d] += f.values[0]
+                    steps.extend(zip([d] * len(f.limits), f.limits, np.diff(f.values)))
+
+        self.polyDims, self.polyM, self.polyS = self.pack_(poly, len(dims))
+        self.expDims, self.expM, self.expS = self.pack_(exp, len(dims))
+        self.stepDims, self.stepLimits, self.stepDeltas = self.pack_(steps, len(dims))
+
+    def __call__(self, t):
+        x = t if np.isscalar(t) else np.asarray(t, dtype=float)[..., np.newaxis]
+        dims = self.base
+        if len(self.polyM):
+            dims = dims + (self.polyM * x / (self.polyS + x)) @ self.polyDims
+        if len(self.expM):
+            dims = dims + (- self.expM * (np.exp(-x / self.expS) - 1)) @ self.expDims
+        if len(self.stepLimits):
+            dims = dims + ((x > self.stepLimits) * self.stepDeltas) @ self.stepDims
+        return (1 + np.min(dims, axis=-1)) * self.capacity0
+
+    def __str__(self):
+        return "CarryingCapacity({})".format(self.capacity0)
+
+    def __repr__(self):
+        return str(self)
+
+    @staticmethod
+    def pack_(factors, numDims):
+        # Returns a (numFactors, numDims) membership matrix, so that summing each
+        # dimension's factors is one matrix product, followed by the parameter arrays
+        membership = np.zeros((len(factors), numDims))
+        membership[np.arange(len(factors)), [f[0] for f in factors]] = 1.0
+        params = np.array([f[1:] for f in factors], dtype=float).reshape(len(factors), 2)
+        return membership, params[:, 0], params[:, 1]
+
+def isCompilable_(dim):
+    return (isinstance(dim, util.SumCallablesFtn) and
+            all(isinstance(f, (util.PolyChangeFtn, util.ExpChangeFtn)) or
+                (isinstance(f, util.PiecewiseFtn) and not f.isFunction)
+                for f in dim.callables))
+
 class LogisticModel:
+    jacobianBands = (0, 0)
+
     def __init__(self, rate, population0, capacity):
         self.rate = rate               # Growth rate
         self.population0 = population0 # Initial population size
@@ -38,20 +106,51 @@ class LogisticModel:
     def __repr__(self):
         return str(self)
 
+    def parameters(self):
+        return {'rate': self.rate, 'population0': self.population0, 'capacity': str(self.capacity)}
+
     def __call__(self, p, t):
         # P'(t) = rate * p(t) * (1 - p(t) / capacity(t))
         return self.rate * p * (1 - p / self.capacity(t))
 
-def solve(model, maxTime=10):
+    def jacobian(self, p, t):
+        return np.array([self.rate * (1 - 2 * np.asarray(p) / self.capacity(t))]).reshape(1, 1)
+
+def solve(model, maxTime=10, jacobian=True, banded=False, method='odeint', rtol=None, atol=None, profile=None, substeps=1):
+    # profile, an integ.SolveProfile, also times the capacity and each dimension;
+    # substeps sets rk4's fixed steps per output interval
+    if profile is not None:
+        model = profiledModel_(model, profile)
     t = np.linspace(0, maxTime, maxTime + 1)
-    p = odeint(model, model.population0, t)
+    p = integ.integrate(model,
+                        np.atleast_1d(model.population0),
+                        t,
+                        method=method,
+                        rtol=rtol,
+                        atol=atol,
+                        substeps=substeps,
+                        jacobianArgs=util.jacobianArgs(model, jacobian, banded),
+                        profile=profile)
     return t, p
 
-def plotConstLines_(t, cPoints):
-    plt.plot(t, cPoints.minLine(), 'c', label='Min Capacity')
-    plt.plot(t, cPoints.maxLine(), 'g', label='Max Capacity')
+def profiledModel_(model, profile):
+    capacity = model.capacity
+    if isinstance(capacity, CarryingCapacity):
+        capacity = CarryingCapacity(capacity.capacity0,
+                                    [profile.track('Dimension {}'.format(getattr(dim, 'name', d)), dim)
+                                     for d, dim in enumerate(capacity.dimensions())])
+    return LogisticModel(model.rate, model.population0, profile.track('Capacity', capacity))
+
+def plotConstLines_(t, cPoints, ax=None):
+    import matplotlib.pyplot as plt
+    ax = plt if ax is None else ax
+    # Constant lines need only their end points
+    ends = [0, -1]
+    ax.plot(np.asarray(t)[ends], cPoints.minLine()[ends], 'c', label='Min Capacity')
+    ax.plot(np.asarray(t)[ends], cPoints.maxLine()[ends], 'g', label='Max Capacity')
 
 def plotFinish_(legend=None):
+    import matplotlib.pyplot as plt
     plt.xlabel('Time')
     plt.ylabel('Population')
     plt.title('Population Forecast')
@@ -60,19 +159,36 @@ def plotFinish_(legend=None):
     plt.grid(True)
     plt.show()
 
-def plot(model, t, p):
+def plot(model, t, p, bands=None, maxPoints=10000):
+    # bands is an optional (lower, upper) pair shaped like p, e.g. EnsembleStats.band().
+    # Longer series are downsampled to about maxPoints keeping bucket extremes.
+    import matplotlib.pyplot as plt
     cPoints = util.FunctionPoints(model.capacity, t)
     plotConstLines_(t, cPoints)
-    plt.plot(t, cPoints.y, 'r', label='Carrying Capacity')
-    plt.plot(t, p, 'b', label='Population')
+    series = [cPoints.y, p] if bands is None else [cPoints.y, p, bands[0], bands[1]]
+    t, series = util.downsample(t, [np.ravel(s) for s in series], maxPoints)
+    plt.plot(t, series[0], 'r', label='Carrying Capacity')
+    plt.plot(t, series[1], 'b', label='Population')
+    if bands is not None:
+        plt.fill_between(t, series[2], series[3], color='b', alpha=0.2)
     plotFinish_(legend='best')
 
-def animate(model, t, p, legend=None):
+def animate(model, t, p, legend=None, filename=None, maxFrames=None, maxPoints=None):
+    import math_models_animate as anim
     cPoints = util.FunctionPoints(model.capacity, t)
     animation = anim.Animate(t,
-                             [p, cPoints.y],
+                             [np.ravel(p), cPoints.y],
                              labels=['Population', 'Carrying Capacity'],
                              colors=['b', 'r'],
-                             preFtn=lambda: plotConstLines_(t, cPoints))
+                             preFtn=lambda ax=None: plotConstLines_(t, cPoints, ax),
+                             maxPoints=maxPoints)
+    if filename is not None:
+        animation.save(filename,
+                       maxFrames=maxFrames,
+                       title='Population Forecast',
+                       legend=legend,
+                       xlabel='Time',
+                       ylabel='Population')
+        return
     animation.run(interval=20)
     plotFinish_(legend=legend)
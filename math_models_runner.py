@@ -0,0 +1,139 @@
+import os
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+class Scenario:
+    def __init__(self, solveFtn, model, *args, **kwargs):
+        self.solveFtn = solveFtn
+        self.model = model
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return 'Scenario({}, {})'.format(self.solveFtn.__name__, self.model)
+
+    def __repr__(self):
+        return str(self)
+
+    def __call__(self):
+        return self.solveFtn(self.model, *self.args, **self.kwargs)
+
+class WorkerTiming:
+    def __init__(self, pid):
+        self.pid = pid
+        self.numChunks = 0
+        self.numScenarios = 0
+        self.elapsed = 0.0
+
+    def __str__(self):
+        return 'Worker {}: chunks={} scenarios={} elapsed={:.6f}'.format(
+            self.pid,
+            self.numChunks,
+            self.numScenarios,
+            self.elapsed)
+
+    def __repr__(self):
+        return str(self)
+
+    def add(self, numScenarios, elapsed):
+        self.numChunks += 1
+        self.numScenarios += numScenarios
+        self.elapsed += elapsed
+
+class ScenarioRunner:
+    def __init__(self, maxWorkers=None, chunkSize=None, chunksPerWorker=4):
+        self.maxWorkers = maxWorkers if maxWorkers is not None else (os.cpu_count() or 1)
+        self.chunkSize = chunkSize
+        self.chunksPerWorker = chunksPerWorker
+        self.timings = {}
+
+    def chunkSizeFor(self, numScenarios):
+        if self.chunkSize is not None:
+            return self.chunkSize
+        return max(1, -(-numScenarios // (self.maxWorkers * self.chunksPerWorker)))
+
+    def run(self, scenarios):
+        scenarios = list(scenarios)
+        self.timings = {}
+        if not scenarios:
+            return []
+
+        size = self.chunkSizeFor(len(scenarios))
+        chunks = [scenarios[i:i + size] for i in range(0, len(scenarios), size)]
+
+        # Every chunk is drained even after a failure so the shared memory
+        # blocks of chunks that did finish are still unlinked
+        results = []
+        error = None
+        with ProcessPoolExecutor(max_workers=min(self.maxWorkers, len(chunks))) as pool:
+            futures = [pool.submit(runChunk_, chunk) for chunk in chunks]
+            for chunk, future in zip(chunks, futures):
+                try:
+                    name, layout, pid, elapsed, profiles = future.result()
+                except Exception as e:
+                    error = error or e
+                    continue
+                if error is not None:
+                    unlinkChunk_(name)
+                    continue
+                results.extend(readChunk_(name, layout))
+                for i, stats in profiles:
+                    chunk[i].kwargs['profile'].add(stats)
+                self.timings.setdefault(pid, WorkerTiming(pid)).add(len(layout), elapsed)
+        if error is not None:
+            raise(error)
+        return results
+
+    def totalElapsed(self):
+        return sum(timing.elapsed for timing in self.timings.values())
+
+def runChunk_(scenarios):
+    # A profile= keyword arrives as a copy, so each distinct profile is swapped
+    # for a fresh one whose stats() go back for the parent's profile to add()
+    fresh = {}
+    for i, scenario in enumerate(scenarios):
+        profile = scenario.kwargs.get('profile')
+        if profile is not None:
+            fresh.setdefault(id(profile), (i, type(profile)()))
+            scenario.kwargs['profile'] = fresh[id(profile)][1]
+
+    start = time.perf_counter()
+    results = [[np.asarray(a, dtype=np.float64) for a in scenario()] for scenario in scenarios]
+    elapsed = time.perf_counter() - start
+
+    # Results travel back through one shared memory block per chunk; only the
+    # block name and the (offset, shape) layout are pickled.
+    nbytes = sum(a.nbytes for result in results for a in result)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, nbytes))
+    layout = []
+    offset = 0
+    for result in results:
+        shapes = []
+        for a in result:
+            np.ndarray(a.shape, dtype=np.float64, buffer=shm.buf, offset=offset)[...] = a
+            shapes.append((offset, a.shape))
+            offset += a.nbytes
+        layout.append(shapes)
+    name = shm.name
+    shm.close()
+
+    # Ownership passes to the parent, which unlinks the block after copying out
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return name, layout, os.getpid(), elapsed, [(i, profile.stats()) for i, profile in fresh.values()]
+
+def readChunk_(name, layout):
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return [tuple(np.ndarray(shape, dtype=np.float64, buffer=shm.buf, offset=offset).copy()
+                      for offset, shape in shapes)
+                for shapes in layout]
+    finally:
+        shm.close()
+        shm.unlink()
+
+def unlinkChunk_(name):
+    shm = shared_memory.SharedMemory(name=name)
+    shm.close()
+    shm.unlink()
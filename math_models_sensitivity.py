@@ -0,0 +1,255 @@
+import os
+import numpy as np
+from scipy.stats import qmc
+import math_models_epidemic as epidemic
+import math_models_runner as runner
+
+class SensitivityException(Exception):
+    pass
+
+# Summaries reduce trajectories ys shaped (samples, timeSteps, compartments)
+# to one value per sample
+
+class PeakValue:
+    def __init__(self, label):
+        self.label = label
+
+    def __str__(self):
+        return 'Peak {}'.format(self.label)
+
+    def __repr__(self):
+        return 'PeakValue({})'.format(self.label)
+
+    def __call__(self, t, ys, labels):
+        return np.max(ys[:, :, list(labels).index(self.label)], axis=1)
+
+class PeakTime:
+    def __init__(self, label):
+        self.label = label
+
+    def __str__(self):
+        return 'Peak {} time'.format(self.label)
+
+    def __repr__(self):
+        return 'PeakTime({})'.format(self.label)
+
+    def __call__(self, t, ys, labels):
+        return np.asarray(t)[np.argmax(ys[:, :, list(labels).index(self.label)], axis=1)]
+
+class FinalValue:
+    def __init__(self, label):
+        self.label = label
+
+    def __str__(self):
+        return 'Final {}'.format(self.label)
+
+    def __repr__(self):
+        return 'FinalValue({})'.format(self.label)
+
+    def __call__(self, t, ys, labels):
+        return ys[:, -1, list(labels).index(self.label)]
+
+class SweepEvaluator:
+    # Batched: every block of samples is solved as one SweepModel system
+    def __init__(self, modelClass, names, maxTime=10, timeSteps=100, initialConditions=None, method='odeint', **fixed):
+        self.modelClass = modelClass
+        self.names = list(names)
+        self.maxTime = maxTime
+        self.timeSteps = timeSteps
+        self.initialConditions = initialConditions
+        self.method = method
+        self.fixed = fixed
+        self.labels = modelClass().labels
+
+    def __str__(self):
+        return 'SweepEvaluator({}, {})'.format(self.modelClass.__name__, ', '.join(self.names))
+
+    def __repr__(self):
+        return str(self)
+
+    def __call__(self, xs):
+        sweep = epidemic.SweepModel(self.modelClass,
+                                    initialConditions=self.initialConditions,
+                                    **self.fixed,
+                                    **{name: xs[:, j] for j, name in enumerate(self.names)})
+        return epidemic.solveSweep(sweep, self.maxTime, self.timeSteps, method=self.method)
+
+class ModelEvaluator:
+    # Parallel: modelFtn(**sample) builds one model per sample, solved by
+    # solveFtn(model, *args) across a ScenarioRunner pool (serially for maxWorkers=1)
+    def __init__(self, modelFtn, solveFtn, names, labels, *args, maxWorkers=None, **kwargs):
+        self.modelFtn = modelFtn
+        self.solveFtn = solveFtn
+        self.names = list(names)
+        self.labels = labels
+        self.args = args
+        self.maxWorkers = maxWorkers
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return 'ModelEvaluator({}, {})'.format(self.solveFtn.__name__, ', '.join(self.names))
+
+    def __repr__(self):
+        return str(self)
+
+    def __call__(self, xs):
+        scenarios = [runner.Scenario(self.solveFtn,
+                                     self.modelFtn(**dict(zip(self.names, (float(v) for v in x)))),
+                                     *self.args,
+                                     **self.kwargs)
+                     for x in xs]
+        if self.maxWorkers == 1:
+            results = [scenario() for scenario in scenarios]
+        else:
+            results = runner.ScenarioRunner(maxWorkers=self.maxWorkers).run(scenarios)
+        t = results[0][0]
+        return t, np.stack([np.asarray(y).reshape(len(t), -1) for _, y in results])
+
+class SobolResult:
+    def __init__(self, names, summaries, first, total, numBase):
+        self.names = names
+        self.summaries = summaries
+        self.first = first
+        self.total = total
+        self.numBase = numBase
+
+    def __str__(self):
+        rows = ['{:<20}'.format('') + ''.join('{:>16}'.format(name) for name in self.names)]
+        for s, summary in enumerate(self.summaries):
+            rows.append('{:<20}'.format(str(summary) + ' S1') + ''.join('{:>16.4f}'.format(v) for v in self.first[s]))
+            rows.append('{:<20}'.format(str(summary) + ' ST') + ''.join('{:>16.4f}'.format(v) for v in self.total[s]))
+        return '\n'.join(rows)
+
+    def __repr__(self):
+        return 'SobolResult({}, {})'.format(len(self.summaries), len(self.names))
+
+class MorrisResult:
+    def __init__(self, names, summaries, mu, muStar, sigma, numTrajectories):
+        self.names = names
+        self.summaries = summaries
+        self.mu = mu
+        self.muStar = muStar
+        self.sigma = sigma
+        self.numTrajectories = numTrajectories
+
+    def __str__(self):
+        rows = ['{:<20}'.format('') + ''.join('{:>16}'.format(name) for name in self.names)]
+        for s, summary in enumerate(self.summaries):
+            rows.append('{:<20}'.format(str(summary) + ' mu*') + ''.join('{:>16.4f}'.format(v) for v in self.muStar[s]))
+            rows.append('{:<20}'.format(str(summary) + ' sigma') + ''.join('{:>16.4f}'.format(v) for v in self.sigma[s]))
+        return '\n'.join(rows)
+
+    def __repr__(self):
+        return 'MorrisResult({}, {})'.format(len(self.summaries), len(self.names))
+
+def scale_(unit, bounds):
+    bounds = np.asarray(bounds, dtype=float)
+    return bounds[:, 0] + unit * (bounds[:, 1] - bounds[:, 0])
+
+def saltelliSample(bounds, numBase, seed=None):
+    # Rows A, B, then AB_i (A with column i from B) for each parameter i,
+    # shaped (numBase * (numParameters + 2), numParameters)
+    numParameters = len(bounds)
+    ab = qmc.Sobol(2 * numParameters, scramble=True, seed=seed).random(numBase)
+    a, b = ab[:, :numParameters], ab[:, numParameters:]
+    abs_ = []
+    for i in range(numParameters):
+        abi = a.copy()
+        abi[:, i] = b[:, i]
+        abs_.append(abi)
+    return scale_(np.vstack([a, b] + abs_), bounds)
+
+def morrisSample(bounds, numTrajectories, levels=4, seed=None):
+    # One-at-a-time trajectories on a levels grid, shaped
+    # (numTrajectories, numParameters + 1, numParameters), and the step signs
+    rng = np.random.default_rng(seed)
+    numParameters = len(bounds)
+    delta = levels / (2 * (levels - 1))
+    start = rng.integers(0, levels // 2, (numTrajectories, numParameters)) / (levels - 1)
+    points = np.empty((numTrajectories, numParameters + 1, numParameters))
+    order = np.argsort(rng.random((numTrajectories, numParameters)), axis=1)
+    signs = rng.choice([-1.0, 1.0], (numTrajectories, numParameters))
+    x = np.where(signs > 0, start, start + delta)
+    points[:, 0] = x
+    for step in range(numParameters):
+        x = x.copy()
+        rows = np.arange(numTrajectories)
+        x[rows, order[:, step]] += signs[rows, order[:, step]] * delta
+        points[:, step + 1] = x
+    return scale_(points, bounds), order, signs, delta
+
+def checkpointSeed(seed, checkpoint):
+    # With a checkpoint and no seed, the seed saved in the checkpoint, or a
+    # fresh one that evaluate() saves, so a rerun regenerates the same samples
+    if seed is not None or checkpoint is None:
+        return seed
+    if os.path.exists(checkpoint):
+        with np.load(checkpoint) as data:
+            if 'seed' in data:
+                return int(data['seed'])
+    return int(np.random.default_rng().integers(2 ** 63))
+
+def evaluate(evaluator, xs, summaries, batchSize=10000, checkpoint=None, seed=None):
+    # Summary values shaped (len(xs), len(summaries)). With a checkpoint path,
+    # progress is saved after every batch, with an integer seed if given,
+    # and a rerun resumes where it stopped.
+    values = np.full((len(xs), len(summaries)), np.nan)
+    done = 0
+    if checkpoint is not None and os.path.exists(checkpoint):
+        with np.load(checkpoint) as data:
+            if not np.array_equal(data['xs'], xs) or data['values'].shape != values.shape:
+                raise(SensitivityException(
+                    "evaluate: checkpoint ({}) was written for different samples".format(checkpoint)))
+            values = data['values']
+            done = int(data['done'])
+
+    saved = {'seed': seed} if isinstance(seed, (int, np.integer)) else {}
+    for start in range(done, len(xs), batchSize):
+        stop = min(start + batchSize, len(xs))
+        t, ys = evaluator(xs[start:stop])
+        for s, summary in enumerate(summaries):
+            values[start:stop, s] = summary(t, ys, evaluator.labels)
+        if checkpoint is not None:
+            with open(checkpoint + '.tmp', 'wb') as f:
+                np.savez(f, xs=xs, values=values, done=stop, **saved)
+            os.replace(checkpoint + '.tmp', checkpoint)
+    return values
+
+def sobol(evaluator, bounds, summaries, numBase=1024, seed=None, batchSize=10000, checkpoint=None):
+    # First order and total indices by the Jansen estimators, shaped
+    # (len(summaries), numParameters). numBase should be a power of 2.
+    numParameters = len(bounds)
+    seed = checkpointSeed(seed, checkpoint)
+    xs = saltelliSample(bounds, numBase, seed)
+    values = evaluate(evaluator, xs, summaries, batchSize, checkpoint, seed)
+
+    fA = values[:numBase]
+    fB = values[numBase:2 * numBase]
+    variance = np.var(np.vstack([fA, fB]), axis=0)
+    first = np.empty((len(summaries), numParameters))
+    total = np.empty((len(summaries), numParameters))
+    for i in range(numParameters):
+        fABi = values[(2 + i) * numBase:(3 + i) * numBase]
+        first[:, i] = 1 - np.mean((fB - fABi) ** 2, axis=0) / (2 * variance)
+        total[:, i] = np.mean((fA - fABi) ** 2, axis=0) / (2 * variance)
+    return SobolResult(evaluator.names, summaries, first, total, numBase)
+
+def morris(evaluator, bounds, summaries, numTrajectories=100, levels=4, seed=None, batchSize=10000, checkpoint=None):
+    # Elementary effects in units of each parameter's range
+    numParameters = len(bounds)
+    seed = checkpointSeed(seed, checkpoint)
+    points, order, signs, delta = morrisSample(bounds, numTrajectories, levels, seed)
+    values = evaluate(evaluator, points.reshape(-1, numParameters), summaries, batchSize, checkpoint, seed)
+    values = values.reshape(numTrajectories, numParameters + 1, len(summaries))
+
+    effects = np.empty((numTrajectories, numParameters, len(summaries)))
+    rows = np.arange(numTrajectories)
+    for step in range(numParameters):
+        i = order[:, step]
+        effects[rows, i] = ((values[:, step + 1] - values[:, step]) * (signs[rows, i] / delta)[:, np.newaxis])
+    return MorrisResult(evaluator.names,
+                        summaries,
+                        effects.mean(axis=0).T,
+                        np.abs(effects).mean(axis=0).T,
+                        effects.std(axis=0, ddof=1).T,
+                        numTrajectories)
@@ -0,0 +1,85 @@
+import numpy as np
+import math_models_epidemic as epidemic
+
+# Finite population realizations of epidemic models. Models are taken through
+# their FlowModel form; a flow's flux on fractions times the population size
+# is its event propensity, so SIRModel/SEIRModel parameters carry over as is.
+# Results are counts shaped (replicates, timeSteps, compartments).
+
+def flowModel_(model):
+    return model if isinstance(model, epidemic.FlowModel) else model.flowModel()
+
+def initialCounts_(flow, population):
+    return np.round(np.asarray(flow.initialConditions, dtype=float) * population).astype(np.int64)
+
+def propensities_(flow, counts, population):
+    return (flow.flux(counts.T / population) * population).T
+
+def gillespie(model, population, maxTime=10, timeSteps=100, replicates=1000, seed=None):
+    # Exact stochastic simulation, one event per replicate per iteration with
+    # all replicates advanced together
+    flow = flowModel_(model)
+    stoichiometry = flow.stoichiometry().astype(np.int64)
+    rng = np.random.default_rng(seed)
+    t = np.linspace(0, maxTime, timeSteps)
+
+    counts = np.tile(initialCounts_(flow, population), (replicates, 1))
+    out = np.empty((replicates, timeSteps, flow.numCompartments), dtype=np.int64)
+    time = np.zeros(replicates)
+    nextIndex = np.zeros(replicates, dtype=int)
+    active = np.arange(replicates)
+    while len(active):
+        a = propensities_(flow, counts[active], population)
+        total = a.sum(axis=1)
+        with np.errstate(divide='ignore'):
+            tNew = time[active] + rng.exponential(1.0, len(active)) / total
+
+        record_(out, t, counts, active, tNew, nextIndex)
+
+        live = np.isfinite(tNew)
+        u = rng.random(len(active)) * total
+        event = np.minimum(np.sum(np.cumsum(a, axis=1) < u[:, np.newaxis], axis=1), a.shape[1] - 1)
+        counts[active[live]] += stoichiometry.T[event[live]]
+        time[active] = tNew
+        active = active[nextIndex[active] < timeSteps]
+    return t, out
+
+def record_(out, t, counts, active, tNew, nextIndex):
+    # Grid points passed before each replicate's next event hold its current counts
+    while True:
+        reps = active[nextIndex[active] < len(t)]
+        reps = reps[t[nextIndex[reps]] < tNew[np.searchsorted(active, reps)]]
+        if not len(reps):
+            return
+        out[reps, nextIndex[reps]] = counts[reps]
+        nextIndex[reps] += 1
+
+def tauLeap(model, population, maxTime=10, timeSteps=100, replicates=1000, tau=None, seed=None):
+    # Poisson event counts per flow over steps of at most tau, clamped so no
+    # compartment goes negative
+    flow = flowModel_(model)
+    stoichiometry = flow.stoichiometry().astype(np.int64)
+    sources = flow.sourceIndices()
+    rng = np.random.default_rng(seed)
+    t = np.linspace(0, maxTime, timeSteps)
+    tau = (t[1] - t[0]) / 10 if tau is None and timeSteps > 1 else tau
+
+    counts = np.tile(initialCounts_(flow, population), (replicates, 1))
+    out = np.empty((replicates, timeSteps, flow.numCompartments), dtype=np.int64)
+    out[:, 0] = counts
+    for i in range(1, timeSteps):
+        numSteps = max(1, int(np.ceil((t[i] - t[i - 1]) / tau)))
+        h = (t[i] - t[i - 1]) / numSteps
+        for _ in range(numSteps):
+            events = rng.poisson(propensities_(flow, counts, population) * h)
+            for k in range(len(sources)):
+                fired = np.minimum(events[:, k], counts[:, sources[k]])
+                counts += fired[:, np.newaxis] * stoichiometry[:, k]
+        out[:, i] = counts
+    return t, out
+
+def outbreakProbability(model, counts, label='Removed', threshold=0.1):
+    # Fraction of replicates whose final label compartment exceeds threshold of the population
+    index = flowModel_(model).labels.index(label)
+    final = counts[:, -1, :]
+    return np.mean(final[:, index] > threshold * np.sum(final, axis=1))
@@ -0,0 +1,117 @@
+import os
+import json
+import numpy as np
+import math_models_util as util
+
+class ResultStoreException(Exception):
+    pass
+
+class ResultStore:
+    # Directory of runs, each saved as <id>_t.npy and <id>_ys.npy, plus an
+    # append-only index.jsonl with one line per run holding the model type,
+    # repr, parameters and array shapes, so appending costs the same however
+    # many runs the store holds. Runs are read back memory-mapped so consumers
+    # can slice without loading.
+    indexName = 'index.jsonl'
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.index = self.readIndex_()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __str__(self):
+        return 'ResultStore({}, {})'.format(self.directory, len(self))
+
+    def __repr__(self):
+        return str(self)
+
+    def append(self, model, t, ys, **meta):
+        return self.extend([(model, t, ys)], **meta)[0]
+
+    def extend(self, runs, **meta):
+        ids = []
+        records = []
+        for model, t, ys in runs:
+            runId = len(self.index) + len(records)
+            t = np.asarray(t)
+            ys = np.asarray(ys)
+            np.save(self.path_(runId, 't'), t)
+            np.save(self.path_(runId, 'ys'), ys)
+            records.append({'id': runId,
+                            'type': type(model).__name__,
+                            'model': repr(model),
+                            'parameters': jsonable_(model.parameters() if hasattr(model, 'parameters') else {}),
+                            'initialConditions': jsonable_(getattr(model, 'initialConditions', None)),
+                            'tShape': list(t.shape),
+                            'ysShape': list(ys.shape),
+                            'meta': jsonable_(meta)})
+            ids.append(runId)
+        self.appendIndex_(records)
+        return ids
+
+    def info(self, runId):
+        self.check_(runId)
+        return self.index[runId]
+
+    def load(self, runId, mmap=True):
+        self.check_(runId)
+        mode = 'r' if mmap else None
+        return (np.load(self.path_(runId, 't'), mmap_mode=mode),
+                np.load(self.path_(runId, 'ys'), mmap_mode=mode))
+
+    def select(self, **parameters):
+        return [info['id'] for info in self.index
+                if all(info['parameters'].get(name) == value for name, value in parameters.items())]
+
+    def check_(self, runId):
+        if not 0 <= runId < len(self.index):
+            raise(ResultStoreException(
+                "ResultStore: invalid run id ({}) - store has {} runs".format(runId, len(self.index))))
+
+    def path_(self, runId, name):
+        return os.path.join(self.directory, '{:08d}_{}.npy'.format(runId, name))
+
+    def readIndex_(self):
+        # A line cut short by a crash mid-append is dropped so later appends
+        # start on a fresh line
+        path = os.path.join(self.directory, self.indexName)
+        if not os.path.exists(path):
+            return []
+        with open(path, 'rb') as f:
+            data = f.read()
+        complete = data[:data.rfind(b'\n') + 1]
+        if len(complete) < len(data):
+            with open(path, 'r+b') as f:
+                f.truncate(len(complete))
+        return [json.loads(line) for line in complete.decode().splitlines()]
+
+    def appendIndex_(self, records):
+        # Encoded before writing so a record that cannot be serialized leaves
+        # the index unchanged
+        lines = ''.join(json.dumps(record) + '\n' for record in records)
+        with open(os.path.join(self.directory, self.indexName), 'a') as f:
+            f.write(lines)
+        self.index.extend(records)
+
+def jsonable_(value):
+    if isinstance(value, dict):
+        return {str(k): jsonable_(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [jsonable_(v) for v in value]
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if callable(value):
+        # Only reprs that determine the function's values; a lambda's repr is
+        # a reusable memory address
+        if not util.hasValueRepr(value):
+            raise(TypeError("jsonable_: callable ({!r}) has no value repr".format(value)))
+        return repr(value)
+    return value
@@ -1,12 +1,33 @@
+import math
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
 import numpy as np
+from scipy import sparse
 import math_models_util as util
 import math_models_population as population
 import math_models_epidemic as epidemic
+import math_models_animate as anim
+import math_models_runner as runner
+import math_models_bench as bench
+import math_models_store as store
+import math_models_cache as cache
+import math_models_integrate as integ
+import math_models_stochastic as stochastic
+import math_models_fit as fit
+import math_models_ensemble as ensemble
+import math_models_sensitivity as sensitivity
 
 def fequal(lhs, rhs):
     return np.abs(lhs - rhs) <= 0.0000001
 
+def numericJacobian(model, y, t, h=1e-6):
+    y = np.asarray(y, dtype=float)
+    return np.array([(np.array(model(y + dy, t)) - np.array(model(y - dy, t))) / (2 * h)
+                     for dy in np.eye(len(y)) * h]).reshape(len(y), -1).T
+
 def tequal(tuple1, tuple2):
     for lhs, rhs in zip(tuple1, tuple2):
         if not fequal(lhs, rhs):
@@ -142,6 +163,57 @@ class TestMathModelsUtil(unittest.TestCase):
         self.assertEqual(pw(1), 5)
         self.assertEqual(pw(2), 10)
 
+    def testPiecewiseFtnArray(self):
+        pw = util.PiecewiseFtn([-1, 0, 1], [-10, -5, 5, 10])
+        x = np.array([-2, -1, -0.5, 0, 0.5, 1, 2])
+        self.assertTrue(np.array_equal(pw(x), [-10, -10, -5, -5, 5, 5, 10]))
+        self.assertTrue(np.array_equal(pw(x), [pw(xi) for xi in x]))
+
+    def testPiecewiseFtnFunctionValues(self):
+        pw = util.PiecewiseFtn([0, 1], [lambda x: -x, lambda x: 2 * x, lambda x: x + 1])
+        self.assertEqual(pw(-1), 1)
+        self.assertEqual(pw(1), 2)
+        self.assertEqual(pw(2), 3)
+        self.assertTrue(np.array_equal(pw(np.array([-1, 0, 0.5, 1, 2])), [1, 0, 1, 2, 3]))
+
+        # Values that only take scalars still work on arrays
+        pw = util.PiecewiseFtn([4], [lambda x: 1.0 if x > 2 else 0.0, math.sqrt])
+        self.assertTrue(np.array_equal(pw(np.array([1.0, 3.0, 9.0])), [0.0, 1.0, 3.0]))
+        self.assertTrue(np.array_equal(util.FunctionPoints(pw, np.array([1.0, 3.0, 16.0])).y, [0.0, 1.0, 4.0]))
+
+    def testCachedFtn(self):
+        calls = []
+        cf = util.CachedFtn(lambda x: calls.append(x) or 2 * x, maxSize=2)
+        self.assertEqual(cf(1), 2)
+        self.assertEqual(cf(1), 2)
+        self.assertEqual(cf(2), 4)
+        self.assertEqual(cf(3), 6)
+        self.assertEqual(cf(1), 2)
+        self.assertEqual(calls, [1, 2, 3, 1])
+        self.assertEqual(cf.stats(), {'hits': 1, 'misses': 4, 'size': 2})
+        cf.clear()
+        self.assertEqual(cf.stats(), {'hits': 0, 'misses': 0, 'size': 0})
+
+    def testTabulatedFtn(self):
+        tf = util.TabulatedFtn(util.PolyChangeFtn(1, 1), 0, 10, numPoints=1001, tolerance=1e-4)
+        self.assertTrue(fequal(tf(0), 0))
+        self.assertTrue(np.abs(tf(2.5) - 2.5 / 3.5) < 1e-4)
+        self.assertTrue(fequal(tf(20), 20 / 21))
+        self.assertTrue(np.allclose(tf(np.array([1, 5, 20])), [0.5, 5 / 6, 20 / 21], atol=1e-4))
+        self.assertEqual(tf.stats(), {'hits': 4, 'misses': 2, 'size': 1001})
+        with self.assertRaises(util.PopulationUtilException):
+            util.TabulatedFtn(util.PiecewiseFtn([5], [0, 1]), 0, 10, numPoints=11, tolerance=1e-4)
+
+    def testBandedMatrix(self):
+        m = np.array([[1, 2, 0, 0],
+                      [3, 4, 5, 0],
+                      [0, 6, 7, 8],
+                      [0, 0, 9, 10]])
+        self.assertTrue(np.array_equal(util.bandedMatrix(m, 1, 1),
+                                       [[0, 2, 5, 8],
+                                        [1, 4, 7, 10],
+                                        [3, 6, 9, 0]]))
+
     def testFunctionPoints(self):
         fp = util.FunctionPoints(lambda x: 2 * x, np.array([1, 4, 3, 5, 2]))
         self.assertTrue(np.all(fp.y == np.array([2, 8, 6, 10, 4])))
@@ -160,7 +232,62 @@ class TestMathModelsUtil(unittest.TestCase):
         self.assertEqual(mmr.xRange(), (0.95, 3.05))
         self.assertEqual(mmr.yRange(), (-1.05, 4.05))
 
+    def testMinMax(self):
+        a = np.random.default_rng(0).normal(size=100000)
+        self.assertEqual(util.minMax(a, chunkSize=1000), (a.min(), a.max()))
+        self.assertEqual(util.minMax([3.0], [1.0, 2.0], [[5.0], [-1.0]]), (-1.0, 5.0))
+
+    def testDownsample(self):
+        x = np.linspace(0, 100, 100001)
+        ys = [np.sin(x), np.random.default_rng(1).normal(size=len(x))]
+        xd, yd = util.downsample(x, ys, 2000)
+        self.assertTrue(len(xd) <= 2002)
+        self.assertEqual((xd[0], xd[-1]), (x[0], x[-1]))
+        for y, d in zip(ys, yd):
+            self.assertEqual((d.min(), d.max()), (y.min(), y.max()))
+            self.assertTrue(np.array_equal(d, y[np.searchsorted(x, xd)]))
+
+        xd, yd = util.downsample(x, ys, 2000, method='lttb')
+        self.assertTrue(len(xd) <= 2000)
+        self.assertTrue(np.all(np.diff(xd) > 0))
+
+        xd, yd = util.downsample(x[:10], [ys[0][:10]], 2000)
+        self.assertEqual(len(xd), 10)
+        with self.assertRaises(util.PopulationUtilException):
+            util.downsample(x, ys, 2000, method='mean')
+
+    def testLTTB(self):
+        y = np.array([0, 1, 0, 5, 0, 1, 0, 1, 9, 0])
+        self.assertTrue(np.array_equal(util.lttbIndices(np.arange(10), y, 5), [0, 2, 3, 8, 9]))
+        self.assertTrue(np.array_equal(util.lttbIndices(np.arange(10), y, 20), np.arange(10)))
+
+    def testBreakpoints(self):
+        self.assertEqual(len(util.breakpoints(1.0, util.PolyChangeFtn(0.2, 10))), 0)
+        self.assertTrue(np.array_equal(
+            util.breakpoints(util.PiecewiseFtn([5, 1], [0, 1, 2]),
+                             util.MinCallablesFtn([util.PiecewiseFtn([3], [1, 2]),
+                                                   util.CachedFtn(util.PiecewiseFtn([5], [1, 2]))])),
+            [1, 3, 5]))
+
 class TestMathModelsPopulation(unittest.TestCase):
+    def testSolveProfile(self):
+        capacity = population.CarryingCapacity(
+            1000000,
+            [population.Dimension('Dim1', [util.PolyChangeFtn(0.2, 10), util.PiecewiseFtn([10, 20], [0.0, -0.1, -0.25])]),
+             population.Dimension('Dim2', [util.ExpChangeFtn(0.3, 20)])])
+        model = population.LogisticModel(0.1, 100, capacity)
+        profile = integ.SolveProfile()
+        _, p = population.solve(model, 100, profile=profile)
+        self.assertTrue(np.array_equal(p, population.solve(model, 100)[1]))
+        population.solve(population.LogisticModel(0.1, 100, capacity.compile()), 100, profile=profile)
+
+        callables = profile.callables()
+        self.assertEqual(sorted(callables), ['Capacity', 'Dimension Dim1', 'Dimension Dim2'])
+        self.assertEqual(callables['Capacity']['calls'], profile.rhsCalls + profile.jacobianCalls)
+        self.assertEqual(callables['Dimension Dim1']['calls'], callables['Dimension Dim2']['calls'])
+        self.assertTrue(callables['Dimension Dim1']['calls'] < callables['Capacity']['calls'])
+        self.assertIn('Capacity calls=', str(profile))
+
     def testDimension(self):
         dim = population.Dimension('foobar',
                                    [lambda x: x + 5, lambda x: 2 * x, lambda x: x])
@@ -185,6 +312,32 @@ class TestMathModelsPopulation(unittest.TestCase):
         self.assertEqual(cc(1), 1250000)
         self.assertEqual(cc(2), 1500000)
 
+    def testCompiledCarryingCapacity(self):
+        cc = population.CarryingCapacity(
+            1000000,
+            [population.Dimension(
+                'Dim1',
+                [util.PolyChangeFtn(0.2, 10),
+                 util.PiecewiseFtn([10, 20], [0.0, -0.1, -0.25])]),
+             population.Dimension(
+                 'Dim2',
+                 [util.ExpChangeFtn(0.3, 20),
+                  util.PolyChangeFtn(-0.15, 5)])])
+        compiled = cc.compile()
+        self.assertIsInstance(compiled, population.CompiledCarryingCapacity)
+        self.assertEqual(str(compiled), str(cc))
+        t = np.array([0, 5, 10, 10.5, 20, 25, 100])
+        for ti in t:
+            self.assertAlmostEqual(compiled(ti), cc(ti), places=6)
+        self.assertTrue(np.allclose(compiled(t), [cc(ti) for ti in t], rtol=1e-12))
+
+    def testCompileFallback(self):
+        cc = population.CarryingCapacity(
+            1000,
+            [population.Dimension('Dim1', [util.PolyChangeFtn(0.2, 10), lambda x: 0.1 * x]),
+             population.Dimension('Dim2', [util.PiecewiseFtn([1], [lambda x: x, lambda x: 0])])])
+        self.assertIs(cc.compile(), cc)
+
     def testLogisticModel(self):
         lm = population.LogisticModel(
             0.05,
@@ -201,6 +354,16 @@ class TestMathModelsPopulation(unittest.TestCase):
         self.assertEqual(int(lm(10495, 1)), 519)
         self.assertEqual(int(lm(11014, 2)), 545)
 
+    def testLogisticModelJacobian(self):
+        lm = population.LogisticModel(
+            0.05,
+            100000,
+            population.CarryingCapacity(
+                1000000,
+                [population.Dimension('Dim1', [lambda x: 0.1 * x])]))
+        for p, t in [(10000, 0), (500000, 2), (1500000, 5)]:
+            self.assertTrue(np.allclose(lm.jacobian([p], t), numericJacobian(lm, [p], t, h=1.0), rtol=1e-6))
+
 class TestMathModelsEpidemic(unittest.TestCase):
     def testCompartmentModelBase(self):
         cm = epidemic.CompartmentModelBase(initialConditions=(1, 0, 0),
@@ -221,6 +384,7 @@ class TestMathModelsEpidemic(unittest.TestCase):
         self.assertEqual(cm.labelColor('A'), 'r')
         self.assertEqual(cm.labelColor('B'), 'b')
         self.assertEqual(cm.labelColor('C'), 'g')
+        self.assertEqual(len(cm.breakpoints()), 0)
 
     def testSIRModel(self):
         sir = epidemic.SIRModel(transmitRate=2.0, removeRate=0.75)
@@ -243,5 +407,836 @@ class TestMathModelsEpidemic(unittest.TestCase):
         self.assertTrue(tequal(seir((0.9476261, 0.0349489, 0.012425, 0.005), 0.3),
                                (-0.0601616, 0.0252127, 0.0287364, 0.0062125)))
 
+    def testSIRModelJacobian(self):
+        sir = epidemic.SIRModel(transmitRate=2.0, removeRate=0.75)
+        y = (0.926929080, 0.048845920, 0.024225)
+        self.assertTrue(np.allclose(sir.jacobian(y, 0.3), numericJacobian(sir, y, 0.3), atol=1e-8))
+
+    def testSEIRModelJacobian(self):
+        seir = epidemic.SEIRModel(transmitRate=3.0,
+                                  reducedEIRate=0.25,
+                                  infectRate=1.0,
+                                  removeRate=0.5)
+        y = (0.9476261, 0.0349489, 0.012425, 0.005)
+        self.assertTrue(np.allclose(seir.jacobian(y, 0.3), numericJacobian(seir, y, 0.3), atol=1e-8))
+
+    def testFlowModel(self):
+        for model in [epidemic.SIRModel(transmitRate=2.0, removeRate=0.75),
+                      epidemic.SEIRModel(transmitRate=3.0, reducedEIRate=0.25, infectRate=1.0, removeRate=0.5)]:
+            flow = model.flowModel()
+            y = np.array(model.initialConditions) + 0.05
+            self.assertTrue(tequal(flow(y, 0.1), model(y, 0.1)))
+            self.assertTrue(np.allclose(flow.jacobian(y, 0.1), model.jacobian(y, 0.1)))
+            self.assertEqual(flow.jacobianBands, model.jacobianBands)
+            ys = np.random.default_rng(1).random((model.numCompartments, 5))
+            self.assertTrue(np.allclose(flow(ys, 0.1), model(ys, 0.1)))
+
+    def testFlowModelSEIRD(self):
+        seird = epidemic.FlowModel((0.99, 0.0, 0.01, 0.0, 0.0),
+                                   ['Susceptible', 'Exposed', 'Infected', 'Removed', 'Dead'],
+                                   ['b', 'c', 'r', 'g', 'k'])
+        seird.addFlow('Susceptible', 'Exposed', 3.5, {'Infected': 1.0})
+        seird.addFlow('Exposed', 'Infected', 1.0)
+        seird.addFlow('Infected', 'Removed', 0.45)
+        seird.addFlow('Infected', 'Dead', 0.05)
+        seird.addFlow('Removed', 'Susceptible', 0.1)
+        y = np.array([0.6, 0.1, 0.2, 0.05, 0.05])
+        dS, dE, dI, dR, dD = seird(y, 0)
+        self.assertTrue(fequal(dS, -3.5 * 0.6 * 0.2 + 0.1 * 0.05))
+        self.assertTrue(fequal(dD, 0.05 * 0.2))
+        self.assertTrue(fequal(dS + dE + dI + dR + dD, 0))
+        self.assertTrue(np.allclose(seird.jacobian(y, 0), numericJacobian(seird, y, 0)))
+
+        sparseSeird = epidemic.FlowModel(seird.initialConditions, seird.labels, seird.colors,
+                                         seird.flows, sparseMatrices=True)
+        self.assertTrue(np.allclose(sparseSeird(y, 0), seird(y, 0)))
+        self.assertTrue(np.allclose(sparseSeird.jacobian(y, 0), seird.jacobian(y, 0)))
+        _, ys = epidemic.solve(sparseSeird, 20, 100)
+        self.assertTrue(np.allclose(np.sum(ys, axis=1), 1.0))
+
+    def testSchedule(self):
+        lockdown = util.PiecewiseFtn([2.95, 6.05], [3.5, 1.0, 2.5])
+        model = epidemic.SIRModel(transmitRate=lockdown)
+        self.assertTrue(np.array_equal(model.breakpoints(), [2.95, 6.05]))
+        self.assertEqual(repr(model), 'SIR(PiecewiseFtn([2.95, 6.05], [3.5, 1.0, 2.5]), 0.5)')
+        self.assertTrue(np.allclose(model((0.5, 0.2, 0.3), 4.0), epidemic.SIRModel(1.0)((0.5, 0.2, 0.3), 4.0)))
+        y = np.array([0.5, 0.2, 0.3])
+        self.assertTrue(np.allclose(model.jacobian(y, 7.0), numericJacobian(model, y, 7.0)))
+
+        # Reference integrates each constant piece separately
+        y = np.array(model.initialConditions)
+        for start, stop, rate in [(0, 2.95, 3.5), (2.95, 6.05, 1.0), (6.05, 10, 2.5)]:
+            y = integ.integrate(epidemic.SIRModel(rate), y, [start, stop], rtol=1e-12, atol=1e-12)[-1]
+        for method, tolerance in [('odeint', 1e-6), ('rk4', 1e-5), ('dopri5', 1e-6)]:
+            t, ys = epidemic.solve(model, 10, 101, method=method)
+            self.assertEqual(len(t), 101)
+            self.assertTrue(np.allclose(ys[-1], y, atol=tolerance))
+        ts, yss = zip(*epidemic.solveStream(model, 10, 101, chunkSize=17))
+        self.assertTrue(np.allclose(np.concatenate(yss)[-1], y, atol=1e-6))
+
+        seir = epidemic.SEIRModel(transmitRate=util.SumCallablesFtn([util.PiecewiseFtn([4.0], [0.0, -1.5]),
+                                                                     lambda t: 3.5]))
+        self.assertTrue(np.array_equal(seir.breakpoints(), [4.0]))
+        self.assertEqual(len(epidemic.SEIRModel().breakpoints()), 0)
+
+        # Flow based solvers need constant rates
+        with self.assertRaises(epidemic.EpidemicException):
+            model.flowModel()
+        with self.assertRaises(epidemic.EpidemicException):
+            stochastic.gillespie(model, 100, 10, 11, replicates=2, seed=0)
+        with self.assertRaises(epidemic.EpidemicException):
+            stochastic.tauLeap(model, 100, 10, 11, replicates=2, seed=0)
+        with self.assertRaises(epidemic.EpidemicException):
+            epidemic.MetapopulationModel(seir, sparse.csr_matrix((2, 2)))
+
+    def testCustomModel(self):
+        # Subclasses with their own __call__ and no parameters() still solve
+        class DecayModel(epidemic.CompartmentModelBase):
+            def __init__(self):
+                super().__init__((1.0,), ('Infected',), ('r',))
+
+            def __call__(self, y, t):
+                return (-y[0],)
+
+        model = DecayModel()
+        t, ys = epidemic.solve(model, 2, 21)
+        self.assertTrue(np.allclose(ys[:, 0], np.exp(-t), atol=1e-6))
+        ts, yss = zip(*epidemic.solveStream(model, 2, 21, chunkSize=8))
+        self.assertTrue(np.allclose(np.concatenate(yss), ys))
+        t, ys, (half,) = epidemic.solveEvents(model, [epidemic.ThresholdEvent('Infected', 0.5)], 2, 21)
+        self.assertAlmostEqual(half.times[0], np.log(2), places=5)
+
+    def testMetapopulation(self):
+        mobility = [[0.0, 0.1, 0.0], [0.05, 0.0, 0.2], [0.0, 0.3, 0.0]]
+        ic = [[0.99, 0.0, 0.01, 0.0], [1.0, 0.0, 0.0, 0.0], [1.0, 0.0, 0.0, 0.0]]
+        model = epidemic.MetapopulationModel(epidemic.SEIRModel(reducedEIRate=0.25), sparse.csr_matrix(mobility), ic)
+        self.assertEqual(model.initialConditions.shape, (12,))
+        self.assertTrue(np.allclose(model.mixing.sum(axis=1), 1.0))
+        mobilityParameters = model.parameters()['mobility']
+        self.assertTrue(np.array_equal(sparse.coo_matrix((mobilityParameters['data'],
+                                                          (mobilityParameters['row'], mobilityParameters['col'])),
+                                                         shape=(3, 3)).toarray(), mobility))
+
+        y = np.random.default_rng(1).random(12)
+        self.assertTrue(np.allclose(model.sparseJacobian(y, 0).toarray(), numericJacobian(model, y, 0), atol=1e-6))
+
+        # Infection spreads only through mobility and totals are conserved per region
+        t, ys = epidemic.solveMetapopulation(model, 20, 101)
+        self.assertEqual(ys.shape, (101, 3, 4))
+        self.assertTrue(np.allclose(ys.sum(axis=2), 1.0))
+        self.assertTrue(np.all(ys[-1, :, 3] > 0.1))
+
+        # Uncoupled regions match single model solves
+        isolated = epidemic.MetapopulationModel(epidemic.SIRModel(), sparse.csr_matrix((2, 2)))
+        _, ys = epidemic.solveMetapopulation(isolated, 10, 50)
+        _, expected = epidemic.solve(epidemic.SIRModel(), 10, 50)
+        self.assertTrue(np.allclose(ys[:, 1], expected))
+
+    def testMetapopulationComponents(self):
+        mobility = sparse.block_diag([sparse.csr_matrix([[0, 0.1], [0.2, 0]]),
+                                      sparse.csr_matrix([[0, 0.3, 0], [0, 0, 0.1], [0.1, 0, 0]])])
+        ic = np.tile([1.0, 0.0, 0.0], (5, 1))
+        ic[[0, 3]] = [0.98, 0.02, 0.0]
+        model = epidemic.MetapopulationModel(epidemic.SIRModel(), mobility, ic)
+        components = model.components()
+        self.assertEqual([c.tolist() for c in components], [[0, 1], [2, 3, 4]])
+        self.assertEqual(model.regions(components[1]).numRegions, 3)
+
+        _, serial = epidemic.solveMetapopulation(model, 10, 51)
+        _, parallel = epidemic.solveMetapopulation(model, 10, 51, maxWorkers=2)
+        self.assertTrue(np.allclose(serial, parallel, atol=1e-6))
+
+    def testAgeSEIR(self):
+        contacts = [[3.0, 1.0, 0.5], [1.0, 2.0, 0.8], [0.5, 0.8, 1.5]]
+        model = epidemic.AgeSEIRModel(contacts,
+                                      transmitRate=0.8,
+                                      reducedEIRate=[0.2, 0.1, 0.0],
+                                      removeRate=[0.5, 0.5, 0.3],
+                                      groupFractions=[0.3, 0.5, 0.2],
+                                      groups=['0-19', '20-64', '65+'])
+        self.assertEqual(model.numCompartments, 12)
+        self.assertEqual(model.labels[:3], ('Susceptible 0-19', 'Susceptible 20-64', 'Susceptible 65+'))
+        self.assertEqual(model.labels[model.compartment('Infected', '65+')], 'Infected 65+')
+        self.assertEqual(model.colors[:3], ('#0000ff', '#5555ff', '#aaaaff'))
+        self.assertTrue(fequal(sum(model.initialConditions), 1.0))
+
+        y = np.random.default_rng(0).random(12)
+        self.assertTrue(np.allclose(model.jacobian(y, 0), numericJacobian(model, y, 0), atol=1e-6))
+        self.assertTrue(np.allclose(model.flowModel()(y, 0), model(y, 0)))
+        self.assertEqual(model.flowModel().jacobianBands, model.jacobianBands)
+        batch = np.stack([y, 2 * y], axis=1)
+        self.assertTrue(np.allclose(model(batch, 0)[:, 1], model(2 * y, 0)))
+
+        _, ys = epidemic.solve(model, 30, 301)
+        self.assertTrue(np.allclose(ys.sum(axis=1), 1.0))
+        self.assertEqual(model.totals(ys).shape, (301, 4))
+        self.assertTrue(np.allclose(model.totals(ys)[0], [0.99, 0.01, 0.0, 0.0]))
+
+        # One group with unit contacts is the plain SEIR model
+        single = epidemic.AgeSEIRModel([[1.0]], transmitRate=3.5, reducedEIRate=0.25)
+        _, expected = epidemic.solve(epidemic.SEIRModel(reducedEIRate=0.25), 20, 100)
+        self.assertTrue(np.allclose(epidemic.solve(single, 20, 100)[1], expected))
+
+        for kwargs in [{'contactMatrix': [[1.0, 0.5]]},
+                       {'contactMatrix': np.eye(2), 'groupFractions': [1.0]},
+                       {'contactMatrix': np.eye(2), 'groups': ['young']}]:
+            with self.assertRaises(epidemic.EpidemicException):
+                epidemic.AgeSEIRModel(**kwargs)
+
+    def testSlots(self):
+        sir1 = epidemic.SIRModel()
+        sir2 = epidemic.SIRModel(transmitRate=2.0)
+        self.assertFalse(hasattr(sir1, '__dict__'))
+        self.assertFalse(hasattr(epidemic.SEIRModel(), '__dict__'))
+        self.assertIs(sir1.labels, sir2.labels)
+        self.assertIs(sir1.colors, epidemic.SIRModel.COLORS)
+        with self.assertRaises(AttributeError):
+            sir1.infectRate = 1.0
+
+    def testModelBatch(self):
+        batch = epidemic.ModelBatch(epidemic.SEIRModel,
+                                    transmitRate=np.linspace(2, 5, 8),
+                                    reducedEIRate=0.25,
+                                    initialConditions=(0.98, 0.01, 0.01, 0.0))
+        self.assertEqual(len(batch), 8)
+        self.assertEqual(batch.data.dtype.names,
+                         ('transmitRate', 'reducedEIRate', 'infectRate', 'removeRate', 'initialConditions'))
+
+        model = batch[3]
+        self.assertEqual(repr(model), repr(epidemic.SEIRModel(2 + 3 * 3 / 7, 0.25, 1.0, 0.5)))
+        self.assertEqual(model.initialConditions, (0.98, 0.01, 0.01, 0.0))
+
+        subset = batch[2:5]
+        self.assertEqual(len(subset), 3)
+        self.assertEqual(repr(subset[1]), repr(model))
+        self.assertEqual(epidemic.ModelBatch.fromModels(subset).parameters(), subset.parameters())
+
+        _, ys = epidemic.solveSweep(batch.sweep(), 10, 50)
+        for i in (0, 3, 7):
+            _, expected = epidemic.solve(batch[i], 10, 50)
+            self.assertTrue(np.allclose(ys[i], expected, atol=1e-6))
+
+        with self.assertRaises(epidemic.EpidemicException):
+            epidemic.ModelBatch(epidemic.SIRModel, infectRate=[1.0])
+
+    def testSolveProfile(self):
+        profile = integ.SolveProfile()
+        for rate in [2.0, 3.0]:
+            t, expected = epidemic.solve(epidemic.SEIRModel(transmitRate=rate), 20, 200)
+            _, seir = epidemic.solve(epidemic.SEIRModel(transmitRate=rate), 20, 200, profile=profile)
+            self.assertTrue(np.array_equal(seir, expected))
+        epidemic.solveSweep(epidemic.SweepModel(epidemic.SIRModel, transmitRate=[2.0, 3.0]), 10, 50, profile=profile)
+        self.assertEqual(profile.solves, 3)
+        self.assertEqual(profile.rhsCalls, profile.integratorRhsCalls)
+        self.assertTrue(profile.rhsTime <= profile.elapsed)
+
+    def testSolveJacobian(self):
+        model = epidemic.SEIRModel(transmitRate=50.0, reducedEIRate=0.25)
+        _, expected = epidemic.solve(model, 20, 200, jacobian=False)
+        _, dense = epidemic.solve(model, 20, 200)
+        _, banded = epidemic.solve(model, 20, 200, banded=True)
+        self.assertTrue(np.allclose(dense, expected, atol=1e-6))
+        self.assertTrue(np.allclose(banded, expected, atol=1e-6))
+
+    def testSolveStream(self):
+        model = epidemic.SEIRModel(reducedEIRate=0.25)
+        t, seir = epidemic.solve(model, 20, 501)
+        chunks = list(epidemic.solveStream(model, 20, 501, chunkSize=100))
+        self.assertEqual([len(tc) for tc, _ in chunks], [100, 100, 100, 100, 100, 1])
+        self.assertTrue(np.array_equal(np.concatenate([tc for tc, _ in chunks]), t))
+        self.assertTrue(np.allclose(np.concatenate([yc for _, yc in chunks]), seir, atol=1e-6))
+
+    def testSolveEvents(self):
+        model = epidemic.SIRModel()
+        t, sir, (below, peak) = epidemic.solveEvents(model,
+                                                    [epidemic.ThresholdEvent('Infected', 1e-4),
+                                                     epidemic.PeakEvent('Infected')],
+                                                    100, 1001, chunkSize=50)
+        self.assertEqual(len(below.times), 1)
+        self.assertTrue(fequal(below.values[0], 1e-4))
+        self.assertTrue(t[-1] <= below.times[0] < t[-1] + 0.1)
+        self.assertEqual(sir.shape, (len(t), 3))
+
+        tFull, sirFull = epidemic.solve(model, 100, 1001)
+        self.assertTrue(np.allclose(sir, sirFull[:len(t)], atol=1e-6))
+        self.assertEqual(len(peak.times), 1)
+        self.assertTrue(np.abs(peak.times[0] - tFull[np.argmax(sirFull[:, 1])]) < 0.1)
+        self.assertTrue(0 <= peak.values[0] - np.max(sirFull[:, 1]) < 1e-3)
+
+        # A non-terminal crossing after an earlier terminal one in the same
+        # grid interval is not reported
+        t, sir, (susceptible, infected) = epidemic.solveEvents(model,
+                                                              [epidemic.ThresholdEvent('Susceptible', 0.9, terminal=False),
+                                                               epidemic.ThresholdEvent('Infected', 0.02, direction=1)],
+                                                              10, 3)
+        self.assertEqual(len(infected.times), 1)
+        self.assertEqual(len(susceptible.times), 0)
+        self.assertTrue(t[-1] <= infected.times[0])
+
+    def testSolveEventsScalarTime(self):
+        # Models and schedules that branch on a scalar t, evaluated per grid point
+        class SwitchModel(epidemic.SIRModel):
+            calls = 0
+
+            def __call__(self, sir, t):
+                SwitchModel.calls += 1
+                rate = 1.0 if t > 5 else 3.5
+                return epidemic.SIRModel(rate)(sir, t)
+
+        model = SwitchModel()
+        t, sir, (peak,) = epidemic.solveEvents(model, [epidemic.PeakEvent('Infected')], 10, 101)
+        self.assertEqual(len(t), 101)
+        self.assertEqual(len(peak.times), 1)
+        cached = epidemic.SIRModel(transmitRate=util.CachedFtn(util.PiecewiseFtn([5.0], [3.5, 1.0])))
+        t, sir, (below,) = epidemic.solveEvents(cached, [epidemic.ThresholdEvent('Susceptible', 0.5)], 10, 101)
+        self.assertTrue(len(below.times) == 1 and t[-1] <= below.times[0])
+
+        # With the default chunk size a terminal event stops integration early
+        calls = []
+        for chunkSize in [None, 1000]:
+            SwitchModel.calls = 0
+            t, _, _ = epidemic.solveEvents(model, [epidemic.ThresholdEvent('Infected', 0.02, direction=1)], 100, 1000,
+                                           chunkSize=chunkSize, jacobian=False)
+            self.assertTrue(t[-1] < 1)
+            calls.append(SwitchModel.calls)
+        self.assertTrue(calls[0] < calls[1])
+
+    def testSweepModel(self):
+        sweep = epidemic.SweepModel(epidemic.SIRModel,
+                                    transmitRate=[2.0, 3.0, 4.0],
+                                    removeRate=0.75)
+        self.assertEqual(sweep.numScenarios, 3)
+        self.assertEqual(sweep.numCompartments, 3)
+        self.assertEqual(len(sweep.initialConditions), 9)
+        dy = sweep(sweep.initialConditions, 0.1).reshape(3, 3)
+        for i in range(3):
+            model = sweep.scenario(i)
+            self.assertTrue(tequal(dy[i], model(model.initialConditions, 0.1)))
+
+    def testSolveSweep(self):
+        sweep = epidemic.SweepModel(epidemic.SEIRModel,
+                                    transmitRate=[2.5, 3.5],
+                                    reducedEIRate=[0.0, 0.25])
+        t, ys = epidemic.solveSweep(sweep, 10, 50)
+        self.assertEqual(ys.shape, (2, 50, 4))
+        for i in range(2):
+            _, y = epidemic.solve(sweep.scenario(i), 10, 50)
+            self.assertTrue(np.allclose(ys[i], y, atol=1e-5))
+
+class TestMathModelsImport(unittest.TestCase):
+    # Cold import cost of the solver modules beyond numpy and the scipy parts
+    # they need, as a fraction of those, timed in the same process. Ours costs
+    # about 0.05; an eager matplotlib import alone adds about 0.8.
+    importBudget = 0.25
+
+    def testSolveImportIsLight(self):
+        code = ('import sys, time\n'
+                'start = time.perf_counter()\n'
+                'import numpy, scipy.integrate, scipy.sparse\n'
+                'dependencies = time.perf_counter() - start\n'
+                'start = time.perf_counter()\n'
+                'import math_models_epidemic, math_models_population\n'
+                'elapsed = time.perf_counter() - start\n'
+                'print(elapsed / dependencies, "matplotlib" in sys.modules, "math_models_animate" in sys.modules)\n')
+        out = subprocess.run([sys.executable, '-c', code],
+                             cwd=os.path.dirname(os.path.abspath(__file__)),
+                             capture_output=True,
+                             text=True,
+                             check=True).stdout.split()
+        self.assertEqual(out[1:], ['False', 'False'])
+        self.assertLess(float(out[0]), self.importBudget)
+
+class TestMathModelsAnimate(unittest.TestCase):
+    def testFrames(self):
+        animation = anim.Animate(np.arange(10), [np.arange(10)], labels=['A'], colors=['b'])
+        self.assertEqual(animation.frames(), list(range(1, 11)))
+        self.assertEqual(animation.frames(step=3), [3, 6, 9, 10])
+        self.assertEqual(animation.frames(maxFrames=4), [3, 6, 9, 10])
+
+    def testSaveGif(self):
+        t, sir = epidemic.solve(epidemic.SIRModel(), 10, 50)
+        animation = anim.Animate(t, [sir[:, i] for i in range(3)],
+                                 labels=['S', 'I', 'R'],
+                                 colors=['b', 'r', 'g'],
+                                 preFtn=lambda ax: ax.axhline(0.5, color='k'))
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'sir.gif')
+            self.assertEqual(animation.save(filename, dpi=40, maxFrames=10, legend='best'), 10)
+            from PIL import Image
+            with Image.open(filename) as image:
+                self.assertEqual(image.n_frames, 10)
+                image.seek(9)
+                last = np.array(image.convert('RGB'))
+            # Frames are streamed as changed boxes; the last matches a one frame save
+            self.assertEqual(animation.save(filename, dpi=40, maxFrames=1, legend='best'), 1)
+            with Image.open(filename) as image:
+                self.assertEqual(image.n_frames, 1)
+                self.assertTrue(np.mean(np.abs(np.array(image.convert('RGB'), dtype=int) - last) > 64) < 0.05)
+        self.assertIsNone(animation.lines)
+
+    def testSaveFailure(self):
+        t, sir = epidemic.solve(epidemic.SIRModel(), 10, 20)
+        animation = anim.Animate(t, [sir[:, 1]], labels=['I'], colors=['r'])
+        with tempfile.TemporaryDirectory() as tmp:
+            ffmpeg = os.path.join(tmp, 'ffmpeg')
+            with open(ffmpeg, 'w') as f:
+                f.write('#!/bin/sh\ncat > /dev/null\nexit 1\n')
+            os.chmod(ffmpeg, 0o755)
+            import matplotlib
+            with matplotlib.rc_context({'animation.ffmpeg_path': ffmpeg}):
+                with self.assertRaises(anim.AnimateException):
+                    animation.save(os.path.join(tmp, 'sir.mp4'), dpi=20, maxFrames=3)
+
+    def testMaxPoints(self):
+        x = np.linspace(0, 10, 50001)
+        animation = anim.Animate(x, [np.sin(x), np.cos(x)], labels=['S', 'C'], colors=['b', 'r'], maxPoints=1000)
+        self.assertTrue(len(animation.x) <= 1002)
+        self.assertEqual(len(animation.ys[1]), len(animation.x))
+        self.assertEqual(animation.ys[0].max(), np.sin(x).max())
+
+class TestMathModelsIntegrate(unittest.TestCase):
+    def testExponential(self):
+        t = np.linspace(0, 2, 21)
+        y0 = np.array([[1.0, 2.0], [3.0, 4.0]])
+        expected = np.exp(-t)[:, None, None] * y0
+        for method in integ.methods:
+            ys = integ.integrate(lambda y, ti: -y, y0, t, method=method)
+            self.assertEqual(ys.shape, (21, 2, 2))
+            self.assertTrue(np.allclose(ys, expected, rtol=1e-5), method)
+
+    def testBreakpoints(self):
+        # Slope jumps from 1 to -1 at t=0.95; fixed steps land exactly on it only with a restart
+        step = util.PiecewiseFtn([0.95], [1.0, -1.0])
+        t = np.linspace(0, 2, 11)
+        expected = np.where(t <= 0.95, t, 1.9 - t)
+        for method in integ.methods:
+            ys = integ.integrate(lambda y, ti: np.full_like(y, step(ti)), [0.0], t, method=method, breakpoints=[0.95])
+            self.assertTrue(np.allclose(ys[:, 0], expected, atol=1e-6), method)
+        ys = integ.integrate(lambda y, ti: np.full_like(y, step(ti)), [0.0], t, method='rk4')
+        self.assertFalse(np.allclose(ys[:, 0], expected, atol=1e-6))
+
+    def testSolveProfile(self):
+        profile = integ.SolveProfile()
+        t = np.linspace(0, 10, 101)
+        integ.integrate(lambda y, ti: -1000 * (y - np.cos(ti)), [0.0], t,
+                        jacobianArgs={'Dfun': lambda y, ti: np.array([[-1000.0]])}, profile=profile)
+        self.assertEqual(profile.solves, 1)
+        self.assertEqual(profile.rhsCalls, profile.integratorRhsCalls)
+        self.assertEqual(profile.jacobianCalls, profile.integratorJacobians)
+        self.assertTrue(profile.jacobianCalls > 0)
+        self.assertTrue(profile.steps > 0)
+        self.assertTrue(profile.methodSwitches >= 1)
+        self.assertEqual(profile.stiffOutputs, 100)
+
+        rk4 = integ.SolveProfile()
+        integ.integrate(lambda y, ti: -y, [1.0], t, method='rk4', profile=rk4)
+        self.assertEqual(rk4.rhsCalls, 400)
+        self.assertEqual(rk4.steps, 0)
+
+        total = integ.SolveProfile().add(profile).add(rk4)
+        self.assertEqual(total.solves, 2)
+        self.assertEqual(total.rhsCalls, profile.rhsCalls + 400)
+
+    def testInvalidMethod(self):
+        with self.assertRaises(integ.IntegrateException):
+            integ.integrate(lambda y, t: -y, [1.0], [0, 1], method='euler')
+
+    def testSolveMethods(self):
+        model = epidemic.SEIRModel(reducedEIRate=0.25)
+        _, expected = epidemic.solve(model, 20, 101)
+        for method in ['rk4', 'dopri5', 'RK45', 'LSODA', 'BDF']:
+            _, seir = epidemic.solve(model, 20, 101, method=method, rtol=1e-8, atol=1e-10)
+            self.assertTrue(np.allclose(seir, expected, atol=1e-4 if method == 'rk4' else 1e-6), method)
+        _, seir = epidemic.solve(model, 20, 101, method='rk4', substeps=8)
+        self.assertTrue(np.allclose(seir, expected, atol=1e-7))
+
+    def testSolveSweepMethods(self):
+        sweep = epidemic.SweepModel(epidemic.SIRModel, transmitRate=[2.0, 3.0, 4.0])
+        _, expected = epidemic.solveSweep(sweep, 10, 101)
+        for method in ['rk4', 'dopri5']:
+            _, ys = epidemic.solveSweep(sweep, 10, 101, method=method, rtol=1e-8, atol=1e-10)
+            self.assertTrue(np.allclose(ys, expected, atol=1e-4 if method == 'rk4' else 1e-6), method)
+        _, ys = epidemic.solveSweep(sweep, 10, 101, method='rk4', substeps=8)
+        self.assertTrue(np.allclose(ys, expected, atol=1e-7))
+
+        # dopri5 error control is not averaged down by quiet scenarios
+        rates = np.full(200, 1.0)
+        rates[0] = 60.0
+        _, ys = epidemic.solveSweep(epidemic.SweepModel(epidemic.SIRModel, transmitRate=rates), 10, 101,
+                                    method='dopri5', rtol=1e-6, atol=1e-6)
+        _, alone = epidemic.solve(epidemic.SIRModel(60.0), 10, 101, rtol=1e-12, atol=1e-12)
+        self.assertTrue(np.allclose(ys[0], alone, atol=2e-5))
+
+        # Implicit solve_ivp methods use the band structure, with or without Dfun
+        for method in ['Radau', 'BDF', 'LSODA']:
+            for jacobian in [True, False]:
+                _, ys = epidemic.solveSweep(sweep, 10, 101, jacobian=jacobian, method=method, rtol=1e-8, atol=1e-10)
+                self.assertTrue(np.allclose(ys, expected, atol=1e-6), method)
+
+class TestMathModelsStochastic(unittest.TestCase):
+    def testGillespie(self):
+        model = epidemic.SIRModel(transmitRate=1.5, removeRate=0.5)
+        t, counts = stochastic.gillespie(model, 1000, 20, 41, replicates=400, seed=7)
+        self.assertEqual(counts.shape, (400, 41, 3))
+        self.assertTrue(np.all(counts.sum(axis=2) == 1000))
+        self.assertTrue(np.array_equal(counts[:, 0], np.tile([990, 10, 0], (400, 1))))
+        _, sir = epidemic.solve(model, 20, 41)
+        self.assertTrue(np.allclose(counts[:, -1].mean(axis=0), 1000 * sir[-1], atol=10))
+
+        _, again = stochastic.gillespie(model, 1000, 20, 41, replicates=400, seed=7)
+        self.assertTrue(np.array_equal(counts, again))
+
+    def testTauLeap(self):
+        model = epidemic.SEIRModel(reducedEIRate=0.25)
+        t, counts = stochastic.tauLeap(model, 1000, 20, 41, replicates=400, seed=3)
+        self.assertEqual(counts.shape, (400, 41, 4))
+        self.assertTrue(np.all(counts >= 0))
+        self.assertTrue(np.all(counts.sum(axis=2) == 1000))
+        _, seir = epidemic.solve(model, 20, 41)
+        self.assertTrue(np.allclose(counts[:, -1].mean(axis=0), 1000 * seir[-1], atol=10))
+
+    def testOutbreakProbability(self):
+        # Single initial case with R0 = 2 dies out early with probability ~1/2
+        model = epidemic.SIRModel(transmitRate=1.0, removeRate=0.5, sir0=(0.999, 0.001, 0.0))
+        _, counts = stochastic.gillespie(model, 1000, 60, 31, replicates=1000, seed=11)
+        self.assertTrue(0.4 < stochastic.outbreakProbability(model, counts) < 0.6)
+
+class TestMathModelsFit(unittest.TestCase):
+    def testFitSIR(self):
+        t, sir = epidemic.solve(epidemic.SIRModel(transmitRate=2.5, removeRate=0.4), 10, 21)
+        result = fit.fit(epidemic.SIRModel(), t, sir[:, 1], ['transmitRate', 'removeRate'], labels=['Infected'])
+        self.assertTrue(np.allclose(result.x, [2.5, 0.4], atol=1e-5))
+        self.assertEqual(repr(result.model), repr(epidemic.SIRModel(*result.x)))
+
+    def testFitSEIRRestarts(self):
+        t, seir = epidemic.solve(epidemic.SEIRModel(3.0, 0.1, 0.8, 0.45), 10, 21)
+        seir[5] = np.nan
+        result = fit.fit(epidemic.SEIRModel(reducedEIRate=0.1),
+                         t[1:],
+                         seir[1:],
+                         ['transmitRate', 'infectRate', 'removeRate'],
+                         restarts=3,
+                         seed=0,
+                         maxWorkers=2)
+        self.assertEqual(result.starts.shape, (3, 3))
+        self.assertEqual(len(result.costs), 3)
+        self.assertTrue(np.allclose(result.x, [3.0, 0.8, 0.45], atol=1e-5))
+
+    def testFitLogistic(self):
+        capacity = population.CarryingCapacity(1000, [population.Dimension('Dim1', [util.PolyChangeFtn(0.2, 10)])])
+        t, p = population.solve(population.LogisticModel(0.3, 100, capacity), 20)
+        result = fit.fit(population.LogisticModel(0.1, 50, capacity), t, p, ['rate', 'population0'])
+        self.assertTrue(np.allclose(result.x, [0.3, 100], rtol=1e-5))
+
+    def testFitProblem(self):
+        model = epidemic.SIRModel()
+        t, sir = epidemic.solve(model, 10, 11)
+        problem = fit.FitProblem(model, t, sir, ['transmitRate', 'removeRate'])
+        self.assertTrue(np.allclose(problem.residuals(problem.x0()), 0, atol=1e-6))
+
+        jac = problem.jacobian(problem.x0())
+        h = 1e-5
+        for j, dx in enumerate(np.eye(2) * h):
+            central = (problem.residuals(problem.x0() + dx) - problem.residuals(problem.x0() - dx)) / (2 * h)
+            self.assertTrue(np.allclose(jac[:, j], central, atol=1e-3))
+
+        with self.assertRaises(fit.FitException):
+            fit.FitProblem(model, t, sir, ['infectRate'])
+        with self.assertRaises(fit.FitException):
+            fit.FitProblem(model, t, sir[:, 1], ['removeRate'], labels=['Exposed'])
+
+class TestMathModelsEnsemble(unittest.TestCase):
+    def testMoments(self):
+        model = epidemic.SweepModel(epidemic.SIRModel, transmitRate=np.linspace(2, 5, 200))
+        _, ys = epidemic.solveSweep(model, 10, 50)
+        stats = ensemble.EnsembleStats(reservoirSize=300)
+        for i in range(0, len(ys), 64):
+            stats.update(ys[i:i + 64])
+        stats.update(ys[0])
+        all = np.concatenate([ys, ys[:1]])
+        self.assertEqual(len(stats), 201)
+        self.assertTrue(np.allclose(stats.mean(), all.mean(axis=0)))
+        self.assertTrue(np.allclose(stats.variance(), all.var(axis=0, ddof=1)))
+        self.assertTrue(np.array_equal(stats.min(), all.min(axis=0)))
+        self.assertTrue(np.array_equal(stats.max(), all.max(axis=0)))
+        # Everything fits in the reservoir, so quantiles are exact
+        self.assertTrue(np.allclose(stats.quantiles(), np.quantile(all, (0.05, 0.5, 0.95), axis=0)))
+
+    def testReservoir(self):
+        runs = np.arange(20000, dtype=float).reshape(-1, 1, 1) * np.ones((1, 4, 2))
+        stats = ensemble.EnsembleStats(reservoirSize=1000, seed=5).extend(np.split(runs, 40))
+        self.assertEqual(stats.reservoir_.shape, (1000, 4, 2))
+        self.assertEqual(len(np.unique(stats.reservoir_[:, 0, 0])), 1000)
+        lower, upper = stats.band()
+        self.assertTrue(abs(lower[0, 0] - 1000) < 400)
+        self.assertTrue(abs(upper[0, 0] - 19000) < 400)
+        self.assertTrue(abs(stats.quantiles([0.5])[0, 0, 0] - 10000) < 1000)
+
+    def testEmpty(self):
+        stats = ensemble.EnsembleStats()
+        with self.assertRaises(ensemble.EnsembleStatsException):
+            stats.mean()
+        stats.update(np.zeros((5, 3)))
+        with self.assertRaises(ensemble.EnsembleStatsException):
+            stats.update(np.zeros((4, 3)))
+
+class LinearEvaluator:
+    # y = x0 + 2 x1 on unit ranges: S = (0.2, 0.8, 0) for first and total order
+    names = ['a', 'b', 'c']
+    labels = ['y']
+
+    def __init__(self, failAfter=None):
+        self.calls = 0
+        self.failAfter = failAfter
+
+    def __call__(self, xs):
+        self.calls += 1
+        if self.failAfter is not None and self.calls > self.failAfter:
+            raise RuntimeError('interrupted')
+        return np.zeros(1), (xs @ [1.0, 2.0, 0.0])[:, None, None]
+
+class TestMathModelsSensitivity(unittest.TestCase):
+    def testSobolLinear(self):
+        result = sensitivity.sobol(LinearEvaluator(), [[0, 1]] * 3, [sensitivity.FinalValue('y')], numBase=1024, seed=0)
+        self.assertTrue(np.allclose(result.first, [[0.2, 0.8, 0.0]], atol=0.01))
+        self.assertTrue(np.allclose(result.total, [[0.2, 0.8, 0.0]], atol=0.01))
+
+    def testMorrisLinear(self):
+        result = sensitivity.morris(LinearEvaluator(), [[0, 1], [0, 2], [0, 1]], [sensitivity.FinalValue('y')], 20, seed=0)
+        self.assertTrue(np.allclose(result.muStar, [[1.0, 4.0, 0.0]]))
+        self.assertTrue(np.allclose(result.sigma, 0))
+
+    def testSaltelliSample(self):
+        xs = sensitivity.saltelliSample([[2, 5], [0, 1]], 8, seed=1)
+        self.assertEqual(xs.shape, (32, 2))
+        self.assertTrue(np.all((xs[:, 0] >= 2) & (xs[:, 0] <= 5)))
+        self.assertTrue(np.array_equal(xs[16:24, 0], xs[8:16, 0]))
+        self.assertTrue(np.array_equal(xs[16:24, 1], xs[:8, 1]))
+
+    def testSobolSEIR(self):
+        evaluator = sensitivity.SweepEvaluator(epidemic.SEIRModel,
+                                               ['transmitRate', 'reducedEIRate', 'infectRate', 'removeRate'],
+                                               30,
+                                               301)
+        summaries = [sensitivity.PeakValue('Infected'), sensitivity.PeakTime('Infected'), sensitivity.FinalValue('Removed')]
+        result = sensitivity.sobol(evaluator, [[2, 5], [0, 0.5], [0.5, 1.5], [0.3, 0.7]], summaries, numBase=256, seed=1)
+        self.assertEqual(result.first.shape, (3, 4))
+        self.assertTrue(np.all(result.total > -0.05))
+        self.assertEqual(np.argmax(result.total[0]), 3)
+
+    def testCheckpoint(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            checkpoint = os.path.join(tmp, 'sobol.npz')
+            args = ([[0, 1]] * 3, [sensitivity.FinalValue('y')])
+            with self.assertRaises(RuntimeError):
+                sensitivity.sobol(LinearEvaluator(failAfter=2), *args, numBase=64, seed=0, batchSize=50, checkpoint=checkpoint)
+
+            evaluator = LinearEvaluator()
+            resumed = sensitivity.sobol(evaluator, *args, numBase=64, seed=0, batchSize=50, checkpoint=checkpoint)
+            self.assertEqual(evaluator.calls, 5)
+            expected = sensitivity.sobol(LinearEvaluator(), *args, numBase=64, seed=0)
+            self.assertTrue(np.allclose(resumed.first, expected.first))
+
+            with self.assertRaises(sensitivity.SensitivityException):
+                sensitivity.sobol(LinearEvaluator(), *args, numBase=64, seed=1, checkpoint=checkpoint)
+
+            # Without a seed the checkpoint keeps one, so a rerun resumes
+            for method, kwargs in [(sensitivity.sobol, {'numBase': 64}), (sensitivity.morris, {'numTrajectories': 40})]:
+                checkpoint = os.path.join(tmp, method.__name__ + 'Unseeded.npz')
+                with self.assertRaises(RuntimeError):
+                    method(LinearEvaluator(failAfter=1), *args, batchSize=50, checkpoint=checkpoint, **kwargs)
+                evaluator = LinearEvaluator()
+                method(evaluator, *args, batchSize=50, checkpoint=checkpoint, **kwargs)
+                self.assertEqual(evaluator.calls, 3 if method is sensitivity.morris else 6)
+
+    def testModelEvaluator(self):
+        def build(rate, m):
+            capacity = population.CarryingCapacity(1000, [population.Dimension('Dim1', [util.PolyChangeFtn(m, 10)])])
+            return population.LogisticModel(rate, 100, capacity)
+        evaluator = sensitivity.ModelEvaluator(build, population.solve, ['rate', 'm'], ['Population'], 20, maxWorkers=1)
+        t, ys = evaluator(np.array([[0.1, 0.0], [0.3, 0.5]]))
+        self.assertEqual(ys.shape, (2, 21, 1))
+        self.assertTrue(np.allclose(ys[1], population.solve(build(0.3, 0.5), 20)[1]))
+
+class TestMathModelsRunner(unittest.TestCase):
+    def testScenario(self):
+        model = epidemic.SIRModel()
+        scenario = runner.Scenario(epidemic.solve, model, 10, 50)
+        t, sir = scenario()
+        self.assertEqual(len(t), 50)
+        self.assertEqual(sir.shape, (50, 3))
+
+    def testChunkSize(self):
+        self.assertEqual(runner.ScenarioRunner(maxWorkers=4).chunkSizeFor(100), 7)
+        self.assertEqual(runner.ScenarioRunner(maxWorkers=4).chunkSizeFor(3), 1)
+        self.assertEqual(runner.ScenarioRunner(maxWorkers=4, chunkSize=10).chunkSizeFor(100), 10)
+
+    def testScenarioRunner(self):
+        capacity = population.CarryingCapacity(
+            1000,
+            [population.Dimension('Dim1', [util.PolyChangeFtn(0.2, 10), util.ExpChangeFtn(-0.1, 5)]),
+             population.Dimension('Dim2', [util.PiecewiseFtn([5], [0.0, 0.1])])])
+        scenarios = [runner.Scenario(epidemic.solve, epidemic.SIRModel(transmitRate=rate), 10, 50)
+                     for rate in [2.0, 3.0, 4.0, 5.0]]
+        scenarios.append(runner.Scenario(population.solve,
+                                         population.LogisticModel(0.1, 100, capacity),
+                                         maxTime=20))
+
+        sr = runner.ScenarioRunner(maxWorkers=2, chunkSize=2)
+        results = sr.run(scenarios)
+        self.assertEqual(len(results), len(scenarios))
+        for scenario, result in zip(scenarios, results):
+            expected = scenario()
+            self.assertTrue(np.array_equal(result[0], expected[0]))
+            self.assertTrue(np.array_equal(result[1], expected[1]))
+        self.assertEqual(sum(timing.numScenarios for timing in sr.timings.values()), 5)
+        self.assertEqual(sum(timing.numChunks for timing in sr.timings.values()), 3)
+
+    def testScenarioRunnerProfile(self):
+        # Worker profiles are merged back into each scenario's profile
+        models = [epidemic.SIRModel(transmitRate=rate) for rate in [2.0, 3.0, 4.0, 5.0]]
+        expected = integ.SolveProfile()
+        for model in models:
+            epidemic.solve(model, 10, 50, profile=expected)
+        for chunkSize in [1, 3]:
+            profile = integ.SolveProfile()
+            profile.solves = 1
+            scenarios = [runner.Scenario(epidemic.solve, model, 10, 50, profile=profile) for model in models]
+            runner.ScenarioRunner(maxWorkers=2, chunkSize=chunkSize).run(scenarios)
+            self.assertEqual(profile.solves, 5)
+            for name in ['rhsCalls', 'jacobianCalls', 'steps', 'integratorRhsCalls']:
+                self.assertEqual(getattr(profile, name), getattr(expected, name), name)
+
+    def testScenarioRunnerFailure(self):
+        # Blocks from chunks that finished are unlinked when another chunk raises
+        scenarios = [runner.Scenario(epidemic.solve, epidemic.SIRModel(transmitRate=rate), 10, 50)
+                     for rate in [2.0, 3.0, 4.0, 5.0, 6.0]]
+        scenarios.insert(1, runner.Scenario(epidemic.solve, epidemic.SIRModel(), 10, 50, method='invalid'))
+        shm = '/dev/shm'
+        before = set(os.listdir(shm)) if os.path.isdir(shm) else set()
+        with self.assertRaises(integ.IntegrateException):
+            runner.ScenarioRunner(maxWorkers=2, chunkSize=1).run(scenarios)
+        if os.path.isdir(shm):
+            self.assertEqual([name for name in set(os.listdir(shm)) - before if name.startswith('psm_')], [])
+
+class TestMathModelsStore(unittest.TestCase):
+    def testResultStore(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            rs = store.ResultStore(tmp)
+            self.assertEqual(len(rs), 0)
+
+            sirModel = epidemic.SIRModel(transmitRate=2.0)
+            t, sir = epidemic.solve(sirModel, 10, 50)
+            self.assertEqual(rs.append(sirModel, t, sir, tag='base'), 0)
+
+            seirModels = [epidemic.SEIRModel(transmitRate=rate) for rate in [2.0, 3.0]]
+            self.assertEqual(rs.extend([(m,) + epidemic.solve(m, 10, 50) for m in seirModels]), [1, 2])
+
+            reopened = store.ResultStore(tmp)
+            self.assertEqual(len(reopened), 3)
+            info = reopened.info(0)
+            self.assertEqual(info['type'], 'SIRModel')
+            self.assertEqual(info['model'], repr(sirModel))
+            self.assertEqual(info['parameters'], {'transmitRate': 2.0, 'removeRate': 0.5})
+            self.assertEqual(info['ysShape'], [50, 3])
+            self.assertEqual(info['meta'], {'tag': 'base'})
+            self.assertEqual(reopened.select(transmitRate=2.0), [0, 1])
+
+            tLoaded, sirLoaded = reopened.load(0)
+            self.assertIsInstance(sirLoaded, np.memmap)
+            self.assertTrue(np.array_equal(tLoaded, t))
+            self.assertTrue(np.array_equal(sirLoaded[:, 1], sir[:, 1]))
+            with self.assertRaises(store.ResultStoreException):
+                reopened.load(3)
+
+            # One index line per run; a line cut short by a crash is dropped
+            indexPath = os.path.join(tmp, store.ResultStore.indexName)
+            with open(indexPath, 'a') as f:
+                f.write('{"id": 3, "ty')
+            reopened = store.ResultStore(tmp)
+            self.assertEqual(len(reopened), 3)
+            self.assertEqual(reopened.append(sirModel, t, sir), 3)
+            with open(indexPath) as f:
+                self.assertEqual(len(f.readlines()), 4)
+            self.assertEqual(store.ResultStore(tmp).info(3)['model'], repr(sirModel))
+
+class TestMathModelsCache(unittest.TestCase):
+    def testSolveCache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            sc = cache.SolveCache(tmp)
+            model = epidemic.SEIRModel(transmitRate=3.0)
+            t, seir = sc.solve(model, 10, 50)
+            t2, seir2 = sc.solve(epidemic.SEIRModel(transmitRate=3.0), 10, 50)
+            self.assertTrue(np.array_equal(seir, seir2))
+            self.assertTrue(np.array_equal(seir, epidemic.solve(model, 10, 50)[1]))
+            sc.solve(model, 10, 60)
+            sc.solve(epidemic.SIRModel(transmitRate=3.0), 10, 50)
+            self.assertEqual(sc.stats()['hits'], 1)
+            self.assertEqual(sc.stats()['misses'], 3)
+            self.assertEqual(sc.stats()['entries'], 3)
+            self.assertNotEqual(sc.key(epidemic.SIRModel(), 10, 50), sc.key(epidemic.SIRModel(sir0=(0.9, 0.1, 0)), 10, 50))
+            # Entries are renamed into place, leaving no temporary files
+            self.assertEqual(sorted(os.listdir(tmp)), sorted(os.path.basename(path) for path in sc.entries()))
+            with self.assertRaises(cache.SolveCacheException):
+                sc.solve(model, 10, 50, profile=integ.SolveProfile())
+            with self.assertRaises(cache.SolveCacheException):
+                sc.key(population.LogisticModel(0.1, 100, lambda t: 1000), 10, 50)
+
+    def testSolveCacheSchedules(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            sc = cache.SolveCache(tmp)
+            lockdown = util.PiecewiseFtn([3.0], [3.5, 1.0])
+            self.assertEqual(sc.key(epidemic.SIRModel(transmitRate=lockdown), 10, 50),
+                             sc.key(epidemic.SIRModel(transmitRate=util.PiecewiseFtn([3.0], [3.5, 1.0])), 10, 50))
+            self.assertNotEqual(sc.key(epidemic.SIRModel(transmitRate=lockdown), 10, 50),
+                                sc.key(epidemic.SIRModel(transmitRate=util.PiecewiseFtn([3.0], [3.5, 2.0])), 10, 50))
+            # Lambda reprs are memory addresses, so lambda schedules are refused
+            for rate in [lambda t: 2.0,
+                         util.SumCallablesFtn([lockdown, lambda t: 0.5]),
+                         util.PiecewiseFtn([3.0], [lambda t: 3.5, util.PolyChangeFtn(1, 2)])]:
+                with self.assertRaises(cache.SolveCacheException):
+                    sc.solve(epidemic.SIRModel(transmitRate=rate), 10, 50)
+            self.assertEqual(sc.stats()['entries'], 0)
+
+            # Tabulated schedules interpolate, so they key apart from the exact ftn and other grids
+            exact = util.PolyChangeFtn(3.0, 2.0)
+            keys = {sc.key(epidemic.SIRModel(transmitRate=rate), 10, 50)
+                    for rate in [exact, util.TabulatedFtn(exact, 0, 10, 3), util.TabulatedFtn(exact, 0, 10, 11)]}
+            self.assertEqual(len(keys), 3)
+
+    def testSolveCacheEviction(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            sc = cache.SolveCache(tmp)
+            models = [epidemic.SIRModel(transmitRate=rate) for rate in [2.0, 3.0, 4.0]]
+            sc.solve(models[0], 10, 50)
+            sc.maxBytes = 2 * sc.size()
+            sc.solve(models[1], 10, 50)
+            os.utime(sc.path_(sc.key(models[0], 10, 50)), (0, 0))
+            os.utime(sc.path_(sc.key(models[1], 10, 50)), (1, 1))
+            sc.solve(models[0], 10, 50)
+            sc.solve(models[2], 10, 50)
+            self.assertEqual(sc.stats()['entries'], 2)
+            self.assertFalse(os.path.exists(sc.path_(sc.key(models[1], 10, 50))))
+            sc.clear()
+            self.assertEqual(sc.stats(), {'hits': 0, 'misses': 0, 'entries': 0, 'bytes': 0})
+
+class TestMathModelsBench(unittest.TestCase):
+    def testTimeIt(self):
+        calls = []
+        seconds = bench.timeIt(lambda: calls.append(1), repeat=3, number=4)
+        self.assertTrue(seconds >= 0)
+        self.assertEqual(len(calls), 12)
+
+    def testCompareResults(self):
+        baseline = {'a': 1.0, 'b': 2.0, 'c': 1.0}
+        results = {'a': 1.1, 'b': 3.0, 'd': 5.0}
+        self.assertEqual(bench.compareResults(results, baseline, threshold=0.25),
+                         [('b', 2.0, 3.0, 1.5)])
+        self.assertEqual(bench.compareResults(results, baseline, threshold=0.5), [])
+
+    def testRunBenchmarks(self):
+        results = bench.runBenchmarks(names=['util.PiecewiseFtn'], repeat=1)
+        self.assertEqual(list(results.keys()), ['util.PiecewiseFtn.1000000'])
+
 if __name__ == "__main__":
     unittest.main()
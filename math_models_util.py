@@ -1,13 +1,35 @@
+import time
 import numpy as np
+from collections import OrderedDict
 
 class PopulationUtilException(Exception):
     pass
 
-def PolyChangeFtn(m, s):
-    return lambda x: m * x / (s + x)
+class PolyChangeFtn:
+    vectorized = True
 
-def ExpChangeFtn(m, s):
-    return lambda x: - m * (np.exp(-x / s) - 1)
+    def __init__(self, m, s):
+        self.m = m
+        self.s = s
+
+    def __call__(self, x):
+        return self.m * x / (self.s + x)
+
+    def __repr__(self):
+        return 'PolyChangeFtn({}, {})'.format(self.m, self.s)
+
+class ExpChangeFtn:
+    vectorized = True
+
+    def __init__(self, m, s):
+        self.m = m
+        self.s = s
+
+    def __call__(self, x):
+        return - self.m * (np.exp(-x / self.s) - 1)
+
+    def __repr__(self):
+        return 'ExpChangeFtn({}, {})'.format(self.m, self.s)
 
 class ApplyToCallablesFtn:
     def __init__(self, applyFtn, callables):
@@ -17,6 +39,9 @@ class ApplyToCallablesFtn:
     def __call__(self, x):
         return self.applyFtn([f(x) for f in self.callables])
 
+    def __repr__(self):
+        return '{}([{}])'.format(type(self).__name__, ', '.join(repr(f) for f in self.callables))
+
     def name(self):
         return str(self.applyFtn)
 
@@ -43,11 +68,30 @@ class PiecewiseFtn:
         self.values = np.array(values)
         self.isFunction = callable(values[0])
 
+    # Array arguments are split by piece; scalar-only function values are
+    # vectorized per piece
+    vectorized = True
+
     def __call__(self, x):
-        for i in range(len(self.limits)):
-            if self.check_(x, i):
-                return self.value_(x, i)
-        return self.value_(x, -1)
+        # Index i satisfies limits[i - 1] < x <= limits[i], matching check_
+        i = self.index_(x)
+        if np.ndim(i) == 0:
+            return self.value_(x, i)
+        if not self.isFunction:
+            return self.values[i]
+
+        x = np.asarray(x)
+        y = np.empty(x.shape)
+        for j in np.unique(i):
+            mask = i == j
+            y[mask] = evaluate(self.values[j], x[mask])
+        return y
+
+    def __repr__(self):
+        return 'PiecewiseFtn({}, [{}])'.format(self.limits.tolist(), ', '.join(repr(v) for v in self.values.tolist()))
+
+    def index_(self, x):
+        return np.searchsorted(self.limits, x, side='left')
 
     def check_(self, x, i):
         if i > 0:
@@ -57,11 +101,248 @@ class PiecewiseFtn:
     def value_(self, x, i):
         return self.values[i](x) if self.isFunction else self.values[i]
 
+class CachedFtn:
+    def __init__(self, ftn, maxSize=4096):
+        self.ftn = ftn
+        self.maxSize = maxSize
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, x):
+        key = float(x)
+        try:
+            y = self.cache[key]
+        except KeyError:
+            self.misses += 1
+            y = self.ftn(x)
+            self.cache[key] = y
+            if len(self.cache) > self.maxSize:
+                self.cache.popitem(last=False)
+            return y
+        self.hits += 1
+        self.cache.move_to_end(key)
+        return y
+
+    def __str__(self):
+        return str(self.ftn)
+
+    def __repr__(self):
+        return repr(self.ftn)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.cache)}
+
+    def clear(self):
+        self.cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+class TabulatedFtn:
+    vectorized = True
+
+    def __init__(self, ftn, xMin, xMax, numPoints=10001, tolerance=None):
+        self.ftn = ftn
+        self.x = np.linspace(xMin, xMax, numPoints)
+        self.y = evaluate(ftn, self.x)
+        self.hits = 0
+        self.misses = 0
+
+        if tolerance is not None:
+            mid = (self.x[:-1] + self.x[1:]) / 2
+            error = np.max(np.abs(evaluate(ftn, mid) - np.interp(mid, self.x, self.y)))
+            if error > tolerance:
+                raise(PopulationUtilException(
+                    "TabulatedFtn: interpolation error ({}) exceeds tolerance ({}) - increase numPoints".format(
+                        error,
+                        tolerance)))
+
+    def __call__(self, x):
+        if np.isscalar(x):
+            if self.x[0] <= x <= self.x[-1]:
+                self.hits += 1
+                return np.interp(x, self.x, self.y)
+            self.misses += 1
+            return self.ftn(x)
+
+        x = np.asarray(x)
+        inside = (self.x[0] <= x) & (x <= self.x[-1])
+        y = np.interp(x, self.x, self.y)
+        if not np.all(inside):
+            y[~inside] = evaluate(self.ftn, x[~inside])
+        self.hits += int(np.count_nonzero(inside))
+        self.misses += int(inside.size - np.count_nonzero(inside))
+        return y
+
+    def __str__(self):
+        return str(self.ftn)
+
+    def __repr__(self):
+        # The grid changes the values, so it is part of the repr
+        return 'TabulatedFtn({!r}, {}, {}, {})'.format(self.ftn, self.x[0], self.x[-1], len(self.x))
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.x)}
+
+class TimedFtn:
+    # Counts calls and accumulates wall time spent in ftn
+    def __init__(self, ftn, name=None):
+        self.ftn = ftn
+        self.name = name if name is not None else str(ftn)
+        self.vectorized = isVectorized(ftn)
+        self.calls = 0
+        self.elapsed = 0.0
+
+    def __call__(self, x):
+        start = time.perf_counter()
+        try:
+            return self.ftn(x)
+        finally:
+            self.elapsed += time.perf_counter() - start
+            self.calls += 1
+
+    def __str__(self):
+        return str(self.ftn)
+
+    def __repr__(self):
+        return repr(self.ftn)
+
+    def stats(self):
+        return {'calls': self.calls, 'elapsed': self.elapsed}
+
+    def clear(self):
+        self.calls = 0
+        self.elapsed = 0.0
+
+def bandedMatrix(matrix, ml, mu):
+    # Packs matrix into LSODA band storage, banded[i - j + mu, j] = matrix[i, j]
+    n = matrix.shape[1]
+    banded = np.zeros((ml + mu + 1, n))
+    for k in range(-ml, mu + 1):
+        diagonal = np.diagonal(matrix, k)
+        if k >= 0:
+            banded[mu - k, k:] = diagonal
+        else:
+            banded[mu - k, :n + k] = diagonal
+    return banded
+
+def jacobianArgs(model, jacobian=True, banded=False):
+    if not jacobian or not hasattr(model, 'jacobian'):
+        return {}
+    if not banded:
+        return {'Dfun': model.jacobian}
+    ml, mu = model.jacobianBands
+    return {'Dfun': lambda y, t: bandedMatrix(model.jacobian(y, t), ml, mu), 'ml': ml, 'mu': mu}
+
+def breakpoints(*ftns):
+    # Sorted x where any of ftns may jump: PiecewiseFtn limits, collected
+    # through sums, mins and caches. Constants and smooth callables add none.
+    points = set()
+    for ftn in ftns:
+        if isinstance(ftn, PiecewiseFtn):
+            points.update(ftn.limits.tolist())
+            if ftn.isFunction:
+                points.update(breakpoints(*ftn.values))
+        elif isinstance(ftn, ApplyToCallablesFtn):
+            points.update(breakpoints(*ftn.callables))
+        elif isinstance(ftn, (CachedFtn, TimedFtn)):
+            points.update(breakpoints(ftn.ftn))
+    return np.array(sorted(points), dtype=float)
+
+def hasValueRepr(ftn):
+    # True when repr(ftn) pins down its values, so it can key a cache: numbers
+    # and the function classes above, all the way down. Lambdas, closures and
+    # other callables repr as a memory address and do not.
+    if not callable(ftn):
+        return True
+    if isinstance(ftn, (PolyChangeFtn, ExpChangeFtn)):
+        return True
+    if isinstance(ftn, PiecewiseFtn):
+        return all(hasValueRepr(v) for v in ftn.values.tolist())
+    if isinstance(ftn, ApplyToCallablesFtn):
+        return all(hasValueRepr(f) for f in ftn.callables)
+    if isinstance(ftn, (CachedFtn, TabulatedFtn, TimedFtn)):
+        return hasValueRepr(ftn.ftn)
+    return False
+
+def evaluate(ftn, x):
+    return ftn(x) if isVectorized(ftn) else np.vectorize(ftn)(x)
+
+def isVectorized(ftn):
+    return isinstance(ftn, np.vectorize) or getattr(ftn, 'vectorized', False)
+
+def minMax(*arrays, chunkSize=1 << 16):
+    # Min and max over all arrays in one sweep of cache-sized chunks, rather
+    # than a full min pass and a full max pass per array
+    lo, hi = np.inf, -np.inf
+    for a in arrays:
+        a = np.ravel(a)
+        for start in range(0, len(a), chunkSize):
+            chunk = a[start:start + chunkSize]
+            lo = min(lo, chunk.min())
+            hi = max(hi, chunk.max())
+    return lo, hi
+
+def minMaxIndices(ys, numBuckets):
+    # Sorted indices of the first and last points and of each series' min and
+    # max in each of numBuckets equal buckets, so every extreme survives
+    ys = [np.asarray(y) for y in ys]
+    n = len(ys[0])
+    size = -(-n // numBuckets)
+    numBuckets = -(-n // size)
+    offsets = np.arange(numBuckets) * size
+    indices = [np.array([0, n - 1])]
+    for y in ys:
+        padded = np.concatenate((y, np.full(numBuckets * size - n, y[-1]))).reshape(numBuckets, size)
+        indices.append(offsets + np.argmin(padded, axis=1))
+        indices.append(offsets + np.argmax(padded, axis=1))
+    return np.unique(np.minimum(np.concatenate(indices), n - 1))
+
+def lttbIndices(x, y, numPoints):
+    # Largest Triangle Three Buckets: keeps the first and last points and,
+    # per bucket, the point forming the largest triangle with the previously
+    # kept point and the next bucket's mean
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    if numPoints >= n or numPoints < 3:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, numPoints - 1).astype(int)
+    indices = np.empty(numPoints, dtype=int)
+    indices[0] = 0
+    indices[-1] = n - 1
+    a = 0
+    for b in range(numPoints - 2):
+        start, stop = edges[b], edges[b + 1]
+        nextStart, nextStop = edges[b + 1], edges[b + 2] if b + 2 < len(edges) else n
+        cx = x[nextStart:nextStop].mean()
+        cy = y[nextStart:nextStop].mean()
+        area = np.abs((x[a] - cx) * (y[start:stop] - y[a]) - (x[a] - x[start:stop]) * (cy - y[a]))
+        a = start + int(np.argmax(area))
+        indices[b + 1] = a
+    return indices
+
+def downsample(x, ys, maxPoints, method='minmax'):
+    # Returns (x, ys) reduced to shared indices so series stay aligned; series
+    # of at most maxPoints points are returned as is
+    x = np.asarray(x)
+    ys = [np.asarray(y) for y in ys]
+    if maxPoints is None or len(x) <= maxPoints:
+        return x, ys
+    if method == 'minmax':
+        indices = minMaxIndices(ys, max(1, maxPoints // (2 * len(ys))))
+    elif method == 'lttb':
+        indices = np.unique(np.concatenate([lttbIndices(x, y, max(3, maxPoints // len(ys))) for y in ys]))
+    else:
+        raise(PopulationUtilException(
+            "downsample: invalid method ({}) - expected minmax or lttb".format(method)))
+    return x[indices], [y[indices] for y in ys]
+
 class FunctionPoints:
     def __init__(self, ftn, x):
-        self.y = ftn(x) if isinstance(ftn, np.vectorize) else np.vectorize(ftn)(x)
-        self.yMin = np.min(self.y)
-        self.yMax = np.max(self.y)
+        self.y = evaluate(ftn, x)
+        self.yMin, self.yMax = minMax(self.y)
 
     def minLine(self):
         return np.full(len(self.y), self.yMin)
@@ -71,10 +352,8 @@ class FunctionPoints:
 
 class XYsMinMaxRange:
     def __init__(self, x, ys, deltaPct=0.05):
-        self.xMin = np.min(x)
-        self.xMax = np.max(x)
-        self.yMin = min([np.min(y) for y in ys])
-        self.yMax = max([np.max(y) for y in ys])
+        self.xMin, self.xMax = minMax(x)
+        self.yMin, self.yMax = minMax(*ys)
         self.deltaPct = deltaPct
 
     def xRange(self):
@@ -2,7 +2,7 @@ import sys
 import math_models_population as population
 import math_models_util as util
 
-def runPiecewiseChange(animate):
+def piecewiseCapacity():
     space = population.Dimension(
         'space',
         [util.PiecewiseFtn([50, 100], [0.0, 0.10, 0.20]),
@@ -18,16 +18,9 @@ def runPiecewiseChange(animate):
         [util.PiecewiseFtn([70, 100], [0.0, 0.05, 0.10]),
          util.PiecewiseFtn([20, 30, 40], [0.0, -0.05, -0.10, -0.15])])
 
-    capacity = population.CarryingCapacity(10000000, [space, water, food])
-    model = population.LogisticModel(0.02, 4500000, capacity)
-
-    t, p = population.solve(model, maxTime=250)
-    if animate:
-        population.animate(model, t, p, legend='lower right')
-    else:
-        population.plot(model, t, p)
+    return population.CarryingCapacity(10000000, [space, water, food])
 
-def runContinuousChange(animate):
+def continuousCapacity():
     space = population.Dimension(
         'space',
         [util.PolyChangeFtn(0.2, 100),
@@ -43,7 +36,9 @@ def runContinuousChange(animate):
         [util.PolyChangeFtn(0.10, 100),
          util.PolyChangeFtn(-0.15, 20)])
 
-    capacity = population.CarryingCapacity(10000000, [space, water, food])
+    return population.CarryingCapacity(10000000, [space, water, food])
+
+def runModel(animate, capacity):
     model = population.LogisticModel(0.02, 4500000, capacity)
 
     t, p = population.solve(model, maxTime=250)
@@ -52,6 +47,12 @@ def runContinuousChange(animate):
     else:
         population.plot(model, t, p)
 
+def runPiecewiseChange(animate):
+    runModel(animate, piecewiseCapacity())
+
+def runContinuousChange(animate):
+    runModel(animate, continuousCapacity())
+
 def run(which, animate):
     if which == 'piece':
         runPiecewiseChange(animate)